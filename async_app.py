@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from slack_bolt.async_app import AsyncApp
+from slack_sdk.web.async_client import AsyncWebClient
+
+import handlers
+from offload import Offload
+from tenor_search import Tenor
+
+"""Opt in asyncio serving mode (--async). The listeners from handlers.py run on the event loop, awaiting slack
+(ack/respond through Bolt's aiohttp client) and tenor (through AsyncTenorClient), so neither holds a thread while
+waiting. Only database work goes to a bounded pool of threads (workers), which the listeners await through Offload"""
+
+def create_async_app(token: str, signing_secret: str, workers: int, api_url: str = None):
+    if api_url is None:
+        app = AsyncApp(token=token, signing_secret=signing_secret)
+    else:
+        app = AsyncApp(client=AsyncWebClient(token=token, base_url=api_url), signing_secret=signing_secret)
+    Offload.EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="DatabaseWorker")
+    Tenor.HTTP_CLIENT = AsyncTenorClient()
+
+    @app.error
+    async def error_handler(error, body, logger, respond):
+        logger.exception("Error: %s", error)
+        logger.info("Request body: %s", body)
+
+        if respond is not None:
+            await respond(handlers.error_message(error), replace_original=False, response_type="ephemeral")
+
+    app.command(command="/tenor")(handlers.tenor_search)
+    app.action("action_send")(handlers.send_message)
+    app.action("action_next")(handlers.next_message)
+    app.action("action_cancel")(handlers.delete_message)
+    return app
+
+"""aiohttp client for tenor searches, with the same pool size, timeouts and retries as Tenor's requests session
+Responses are read in full, and returned with the parts of requests' Response that Tenor uses"""
+class AsyncTenorClient:
+    def __init__(self):
+        self.__session = None
+
+    async def get(self, url: str, params: dict):
+        # Like requests, parameters without a value are left out
+        params = {key: str(value) for (key, value) in params.items() if value is not None}
+        for attempt in range(Tenor.HTTP_RETRIES + 1):
+            retries_left = attempt < Tenor.HTTP_RETRIES
+            try:
+                async with self.__get_session().get(url, params=params) as resp:
+                    response = AsyncTenorResponse(resp.status, resp.headers, await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not retries_left:
+                    raise
+                logging.info("Retrying tenor request after a connection error (attempt %s)", attempt + 1, exc_info=True)
+                await asyncio.sleep(self.__backoff(attempt))
+                continue
+
+            if response.status_code not in Tenor.HTTP_RETRY_STATUSES or not retries_left:
+                return response
+            await asyncio.sleep(self.__retry_after(response) or self.__backoff(attempt))
+
+    def __get_session(self):
+        # Created on first use, so it belongs to the event loop serving requests
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=Tenor.HTTP_POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(sock_connect=Tenor.HTTP_CONNECT_TIMEOUT,
+                                              sock_read=Tenor.HTTP_READ_TIMEOUT)
+            )
+        return self.__session
+
+    @staticmethod
+    def __backoff(attempt: int):
+        return Tenor.HTTP_RETRY_BACKOFF * (2 ** attempt)
+
+    @staticmethod
+    def __retry_after(response):
+        # Capped like CappedRetry, leaving longer pauses to Tenor.LIMITER
+        try:
+            return min(max(0.0, float(response.headers.get("Retry-After", ""))), Tenor.HTTP_READ_TIMEOUT)
+        except ValueError:
+            return None
+
+class AsyncTenorResponse:
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
@@ -0,0 +1,99 @@
+"""Micro-benchmark of storing tenor pages for a session, comparing the original per-row
+INSERT ... SELECT MAX(position) statement against Tenor.store_page
+Run from the repository root: python -m benchmark.ingest"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from database import Database
+from image import Image
+from migrations import Migrations
+from tenor_search import Tenor
+
+PAGE_SIZE = 5
+
+
+def make_gif(i: int):
+    return {
+        "id": str(i),
+        "content_description": f"Benchmark {i} GIF",
+        "media": [{
+            kind: {"url": f"https://media.tenor.com/{i}/{kind}.gif", "size": size, "dims": [498, 280]}
+            for kind, size in (("gif", 3_000_000), ("mediumgif", 1_200_000), ("tinygif", 200_000), ("nanogif", 60_000))
+        }]
+    }
+
+
+def create_request(db):
+    # language=SQL
+    return db.execute("""
+        INSERT INTO slack_request (timestamp, user_id, conversation_id, block_uid, search_string, status, last_active)
+        VALUES (?, 'U0BENCH', 'C0BENCH', ?, 'benchmark', 'SELECTING', ?)
+        """, (datetime.now().isoformat(), str(uuid.uuid4()), datetime.now().isoformat())).lastrowid
+
+
+def legacy_store_page(db, request_id, results, next_pos):
+    block_uid = db.execute("SELECT block_uid FROM slack_request WHERE id = ?", (request_id,)).fetchone()[0]
+    for i, obj in enumerate(results):
+        pos = next_pos if i + 1 == len(results) else None
+        image = Image.from_tenor(obj)
+        # language=SQL
+        db.execute("""
+            INSERT INTO tenor_result (slack_request_id, position, tenor_id, description, gif_url, gif_size, status,
+                                      next_pos)
+            SELECT
+                sr.id,
+                COALESCE(MAX(position), 0) + 1,
+                ?, ?, ?, ?,
+                'FETCHED',
+                ?
+            FROM slack_request sr
+            LEFT JOIN tenor_result tr ON (sr.id = tr.slack_request_id)
+            WHERE sr.block_uid = ?
+            GROUP BY sr.id
+            """, (image.id, image.description, image.url, image.size, pos, block_uid))
+
+
+def run(store_fn, results_per_session: int, sessions: int):
+    pages = [[make_gif(p * PAGE_SIZE + i) for i in range(PAGE_SIZE)]
+             for p in range((results_per_session + PAGE_SIZE - 1) // PAGE_SIZE)]
+
+    elapsed = 0
+    for _ in range(sessions):
+        with Database() as db:
+            request_id = create_request(db)
+
+        for page_no, page in enumerate(pages):
+            start = time.perf_counter()
+            with Database() as db:
+                store_fn(db, request_id, page, str((page_no + 1) * PAGE_SIZE))
+            elapsed += time.perf_counter() - start
+
+    return elapsed / sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark storing tenor results for a session")
+    parser.add_argument("--sizes", default="5,50,500",
+                        help="Comma separated number of results stored per session")
+    parser.add_argument("--sessions", default=20, type=int,
+                        help="Number of sessions to average over for each size")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="slack-tenor-bench-"))
+    Migrations.migrate()
+
+    print(f"{'results':>8} {'legacy ms':>10} {'bulk ms':>10} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        legacy = run(legacy_store_page, size, args.sessions)
+        bulk = run(Tenor.store_page, size, args.sessions)
+        print(f"{size:>8} {legacy * 1000:>10.2f} {bulk * 1000:>10.2f} {legacy / bulk:>7.1f}x")
+
+    Database.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Load test of the bot over HTTP, against stub tenor and slack servers (see stubs.py), so no network access is needed
+Each flow is a search, some number of next clicks, then a send (or cancel), sent as signed slash command and block
+action requests. Latency is measured from sending a request until the bot's reply arrives at the flow's response_url
+Flows are either generated, or replayed from a JSON lines capture (one flow per line), which can be exported from an
+existing database with --export-capture
+With several bot workers (--workers, or comma separated --app-url) each request goes to a random one, so a search's
+clicks are spread across workers sharing one database (optionally a stub libSQL server, with --stub-database)
+Run from the repository root: python -m benchmark.loadtest --spawn"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+import requests
+
+from benchmark.stubs import StubDatabase, StubSlack, StubTenor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = ["party", "cat", "dog", "thumbs up", "facepalm", "happy friday", "mind blown", "thank you"]
+
+
+def sign(secret: str, timestamp: str, body: str):
+    base = f"v0:{timestamp}:{body}".encode()
+    return "v0=" + hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()
+
+
+def find_button(message: dict, action_id: str):
+    # Returns the block_id and value to click with. In grid mode this is the first gif's send button
+    for block in message.get("blocks", []):
+        for element in block.get("elements", []) if block.get("type") == "actions" else []:
+            if element.get("action_id") == action_id:
+                return block["block_id"], element.get("value")
+    raise ValueError(f"No {action_id} button in reply: {message}")
+
+
+class Driver:
+    def __init__(self, app_urls: list, signing_secret: str, slack: StubSlack, timeout: float):
+        self.app_urls = app_urls
+        self.signing_secret = signing_secret
+        self.slack = slack
+        self.timeout = timeout
+
+        self.latencies = {}
+        self.acks = []
+        self.errors = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def run_flow(self, flow: dict):
+        flow_id = uuid.uuid4().hex
+        user = {"id": flow.get("user_id", "U0BENCH"), "name": flow.get("user_name", "bench")}
+        channel = {"id": flow.get("channel_id", "C0BENCH"), "name": flow.get("channel_name", "bench")}
+        replies = 0
+        try:
+            replies += 1
+            message = self.__step("search", flow_id, replies, self.__command_body(flow_id, user, channel, flow["query"]))
+
+            finish = flow.get("finish", "send")
+            clicks = ["next"] * flow.get("nexts", 0) + ([finish] if finish in ("send", "cancel") else [])
+            for action in clicks:
+                replies += 1
+                body = self.__action_body(flow_id, user, channel, action, *find_button(message, f"action_{action}"))
+                message = self.__step(action, flow_id, replies, body)
+        except Exception as e:
+            with self.__lock:
+                self.errors.append(f"{flow['query']!r}: {e}")
+        finally:
+            self.slack.forget(flow_id)
+
+    def __step(self, name: str, flow_id: str, reply: int, body: str):
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "X-Slack-Request-Timestamp": timestamp,
+            "X-Slack-Signature": sign(self.signing_secret, timestamp, body)
+        }
+
+        start = time.perf_counter()
+        resp = self.__session().post(random.choice(self.app_urls), data=body.encode(), headers=headers,
+                                     timeout=self.timeout)
+        acked = time.perf_counter()
+        if not resp.ok:
+            raise RuntimeError(f"{name} got status code {resp.status_code}")
+
+        message = self.slack.wait_for(flow_id, reply, self.timeout)
+        done = time.perf_counter()
+        if "text" in message and "blocks" not in message and not message.get("delete_original"):
+            # Eg. the error message, or the search having expired (cancelling only deletes the message)
+            raise RuntimeError(f"{name} got reply: {message['text']}")
+
+        with self.__lock:
+            self.latencies.setdefault(name, []).append(done - start)
+            self.acks.append(acked - start)
+        return message
+
+    def __session(self):
+        # One per thread, so requests reuse connections without sharing a session between threads
+        if not hasattr(self.__local, "session"):
+            self.__local.session = requests.Session()
+        return self.__local.session
+
+    def __command_body(self, flow_id: str, user: dict, channel: dict, query: str):
+        return urlencode({
+            "token": "bench",
+            "team_id": "T0STUB",
+            "team_domain": "stub",
+            "channel_id": channel["id"],
+            "channel_name": channel["name"],
+            "user_id": user["id"],
+            "user_name": user["name"],
+            "command": "/tenor",
+            "text": query,
+            "api_app_id": "A0BENCH",
+            "response_url": self.slack.response_url(flow_id),
+            "trigger_id": uuid.uuid4().hex
+        })
+
+    def __action_body(self, flow_id: str, user: dict, channel: dict, action: str, block_id: str, value: str):
+        label = action.capitalize()
+        payload = {
+            "type": "block_actions",
+            "token": "bench",
+            "api_app_id": "A0BENCH",
+            "trigger_id": uuid.uuid4().hex,
+            "team": {"id": "T0STUB", "domain": "stub"},
+            "user": {"id": user["id"], "username": user["name"], "name": user["name"], "team_id": "T0STUB"},
+            "channel": channel,
+            "container": {"type": "message", "message_ts": f"{time.time():.6f}", "channel_id": channel["id"],
+                          "is_ephemeral": True},
+            "response_url": self.slack.response_url(flow_id),
+            "actions": [{
+                "type": "button",
+                "action_id": f"action_{action}",
+                "block_id": block_id,
+                "text": {"type": "plain_text", "text": label, "emoji": True},
+                "value": value,
+                "action_ts": f"{time.time():.6f}"
+            }]
+        }
+        return urlencode({"payload": json.dumps(payload)})
+
+
+def generate_flows(count: int, nexts: int, cancel_rate: float):
+    return [{
+        "offset": 0,
+        "query": random.choice(QUERIES),
+        "nexts": random.randint(0, nexts * 2) if nexts else 0,
+        "finish": "cancel" if random.random() < cancel_rate else "send",
+        "user_id": f"U{random.randrange(50):04}"
+    } for _ in range(count)]
+
+
+def load_capture(path: str):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def export_capture(database: str, path: str):
+    # Each request becomes a flow: the results it used are the clicks made, and its status how it finished
+    connection = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    # language=SQL
+    rows = connection.execute("""
+        SELECT sr.timestamp, sr.user_id, sr.conversation_id, sr.search_string, sr.status,
+               COUNT(tr.id) AS shown
+        FROM slack_request sr
+        LEFT JOIN tenor_result tr ON (tr.slack_request_id = sr.id AND tr.status IN ('USED', 'SELECTING'))
+        GROUP BY sr.id
+        ORDER BY sr.timestamp ASC
+        """).fetchall()
+    connection.close()
+
+    finishes = {"POSTED": "send", "CANCELLED": "cancel"}
+    first = datetime.fromisoformat(rows[0][0]) if rows else None
+    with open(path, "w") as f:
+        for timestamp, user_id, conversation_id, search_string, status, shown in rows:
+            f.write(json.dumps({
+                "offset": (datetime.fromisoformat(timestamp) - first).total_seconds(),
+                "query": search_string,
+                "nexts": max(0, shown - 1),
+                "finish": finishes.get(status, "none"),
+                "user_id": user_id,
+                "channel_id": conversation_id
+            }) + "\n")
+    print(f"Exported {len(rows)} flows to {path}")
+
+
+def run_flows(driver: Driver, flows: list, concurrency: int, speed: float):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="Flow") as executor:
+        for flow in sorted(flows, key=lambda f: f.get("offset", 0)):
+            # Replayed flows keep their original spacing (scaled by speed), generated ones all start at once
+            delay = flow.get("offset", 0) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(driver.run_flow, flow)
+    return time.perf_counter() - start
+
+
+def percentile(values: list, pct: float):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def report(driver: Driver, flows: int, elapsed: float):
+    print(f"{'step':>8} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = list(driver.latencies.items()) + [("(ack)", driver.acks)]
+    for name, values in rows:
+        if values:
+            print(f"{name:>8} {len(values):>7} {percentile(values, 50) * 1000:>9.1f} "
+                  f"{percentile(values, 95) * 1000:>9.1f} {percentile(values, 99) * 1000:>9.1f} "
+                  f"{max(values) * 1000:>9.1f}")
+
+    steps = sum(len(values) for values in driver.latencies.values())
+    print(f"\n{flows} flows, {steps} requests in {elapsed:.2f}s: {steps / elapsed:.1f} requests/s, " +
+          f"{flows / elapsed:.1f} flows/s, {len(driver.errors)} errors")
+    for error in driver.errors[:10]:
+        print(f"  {error}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_bot(args, tenor: StubTenor, slack: StubSlack, directory: str, extra_args: list):
+    # Runs in the given directory, so workers spawned together share its database
+    # The bot's own arguments are passed through
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, "main.py"), "xoxb-bench", args.signing_secret, "bench-key",
+               "--port", str(port), "--tenor-url", tenor.url, "--slack-api-url", slack.api_url] + extra_args + \
+              args.bot_args.split()
+    bot = subprocess.Popen(command, cwd=directory,
+                           stdout=subprocess.DEVNULL, stderr=None if args.bot_output else subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError(f"Bot exited with {bot.returncode} on startup (run with --bot-output to see why)")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return bot, f"http://127.0.0.1:{port}/tenor"
+        except OSError:
+            time.sleep(0.2)
+    bot.kill()
+    raise RuntimeError("Bot did not start listening within 30s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against stub tenor and slack servers")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start the bot (main.py) against the stubs, with a fresh database")
+    parser.add_argument("--bot-args", default="",
+                        help="Extra arguments for the spawned bot, eg. \"--async --metrics-port 9100\"")
+    parser.add_argument("--bot-output", action="store_true",
+                        help="Show the spawned bot's log output")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of bot processes to spawn, sharing one database (with the session cache off)")
+    parser.add_argument("--stub-database", action="store_true",
+                        help="Have the spawned bots use a stub libSQL server, rather than a SQLite file")
+    parser.add_argument("--app-url", default="http://127.0.0.1:1300/tenor",
+                        help="URL of an already running bot when not using --spawn, or comma separated URLs of workers " +
+                             "sharing a database")
+    parser.add_argument("--signing-secret", default="bench-signing-secret",
+                        help="Signing secret the bot was started with")
+    parser.add_argument("--slack-port", default=0, type=int,
+                        help="Port for the stub slack server (a running bot needs --slack-api-url pointing at it)")
+    parser.add_argument("--slack-latency", default=0.0, type=float,
+                        help="Seconds the stub slack takes to accept a response")
+    parser.add_argument("--tenor-port", default=0, type=int,
+                        help="Port for the stub tenor server (a running bot needs --tenor-url pointing at it)")
+    parser.add_argument("--tenor-latency", default=0.05, type=float,
+                        help="Seconds the stub tenor takes to respond")
+    parser.add_argument("--tenor-jitter", default=0.0, type=float,
+                        help="Seconds the stub tenor's latency varies by either way")
+    parser.add_argument("--tenor-result-bytes", default=2000, type=int,
+                        help="Approximate size of each result object from the stub tenor")
+    parser.add_argument("--tenor-error-rate", default=0.0, type=float,
+                        help="Fraction of stub tenor requests that fail with a 503")
+    parser.add_argument("--flows", default=100, type=int,
+                        help="Number of flows to generate")
+    parser.add_argument("--nexts", default=3, type=int,
+                        help="Average number of next clicks in each generated flow")
+    parser.add_argument("--cancel-rate", default=0.1, type=float,
+                        help="Fraction of generated flows that cancel rather than send")
+    parser.add_argument("--replay", default=None,
+                        help="JSON lines capture of flows to replay instead of generating them")
+    parser.add_argument("--speed", default=1.0, type=float,
+                        help="How many times faster than captured to replay flows")
+    parser.add_argument("--export-capture", nargs=2, metavar=("DATABASE", "CAPTURE"),
+                        help="Write the requests stored in a database as a capture for --replay, then exit")
+    parser.add_argument("--concurrency", default=8, type=int,
+                        help="Maximum number of flows in progress at once")
+    parser.add_argument("--timeout", default=30, type=float,
+                        help="Seconds to wait for each reply from the bot")
+    args = parser.parse_args()
+
+    if args.export_capture:
+        export_capture(*args.export_capture)
+        return
+
+    tenor = StubTenor(args.tenor_port, args.tenor_latency, args.tenor_jitter, args.tenor_result_bytes,
+                      args.tenor_error_rate).start()
+    slack = StubSlack(args.slack_port, args.slack_latency).start()
+    print(f"Stub tenor at {tenor.url}, stub slack at {slack.api_url}")
+
+    bots, app_urls, database = [], args.app_url.split(","), None
+    try:
+        if args.spawn:
+            # A fresh database in a temporary directory
+            directory = tempfile.mkdtemp(prefix="slack-tenor-loadtest-")
+            extra_args = ["--session-cache-size", "0"] if args.workers > 1 else []
+            if args.stub_database:
+                database = StubDatabase(os.path.join(directory, "stub_database.db")).start()
+                extra_args += ["--database", database.url]
+                print(f"Stub database at {database.url}")
+            for _ in range(max(1, args.workers)):
+                bots.append(spawn_bot(args, tenor, slack, directory, extra_args))
+            app_urls = [app_url for (_, app_url) in bots]
+
+        flows = load_capture(args.replay) if args.replay else generate_flows(args.flows, args.nexts, args.cancel_rate)
+        driver = Driver(app_urls, args.signing_secret, slack, args.timeout)
+        elapsed = run_flows(driver, flows, args.concurrency, args.speed)
+        report(driver, len(flows), elapsed)
+        print(f"Stub tenor served {tenor.searches} searches and {tenor.shares} share registrations")
+        if database is not None:
+            print(f"Stub database served {database.pipelines} requests")
+    finally:
+        for bot, _ in bots:
+            bot.terminate()
+            bot.wait(10)
+        tenor.stop()
+        slack.stop()
+        if database is not None:
+            database.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""Local stand ins for tenor and slack, so the bot can be load tested without network access or credentials
+StubTenor serves /random and /registershare with configurable latency, page size and result size. StubSlack
+answers the web API calls bolt makes (auth.test), and records what the bot posts to each response_url
+StubDatabase serves a local SQLite file over libSQL's HTTP protocol, for trying out the networked backend
+Run standalone from the repository root: python -m benchmark.stubs"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    def __init__(self, handler, port: int = 0, host: str = "127.0.0.1"):
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubTenor(StubServer):
+    def __init__(self, port: int = 0, latency: float = 0.05, jitter: float = 0.0, result_bytes: int = 2000,
+                 error_rate: float = 0.0):
+        super().__init__(_TenorHandler, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.result_bytes = result_bytes
+        self.error_rate = error_rate
+
+        self.searches = 0
+        self.shares = 0
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    @property
+    def url(self):
+        return super().url + "/v1"
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def page(self, query: str, limit: int, pos: int):
+        with self.__lock:
+            self.searches += 1
+            first = next(self.__ids)
+            # Reserve the rest of the page's ids, so concurrent searches never share results
+            for _ in range(limit - 1):
+                next(self.__ids)
+        results = [self.__result(first + i, query) for i in range(limit)]
+        return {"results": results, "next": str(pos + limit)}
+
+    def __result(self, tenor_id: int, query: str):
+        result = {
+            "id": str(tenor_id),
+            "content_description": f"{query} {tenor_id} GIF",
+            "itemurl": f"https://tenor.com/view/{tenor_id}",
+            "media": [{
+                kind: {"url": f"https://media.tenor.com/stub/{tenor_id}/{kind}.gif", "size": size, "dims": [498, 280]}
+                for kind, size in (("gif", 3_000_000), ("mediumgif", 1_200_000), ("tinygif", 200_000),
+                                   ("nanogif", 60_000))
+            }]
+        }
+        # Real results carry tags, alternative formats etc., so pad to roughly the configured size
+        padding = self.result_bytes - len(json.dumps(result))
+        if padding > 0:
+            result["tags"] = ["x" * 8] * (padding // 12)
+        return result
+
+
+class _TenorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        stub.delay()
+        if random.random() < stub.error_rate:
+            self.__send(503, {"error": "stub error"})
+        elif url.path.endswith("/random"):
+            pos = int(params.get("pos") or 0)
+            self.__send(200, stub.page(params.get("q", ""), int(params.get("limit", 5)), pos))
+        elif url.path.endswith("/registershare"):
+            stub.shares += 1
+            self.__send(200, {})
+        else:
+            self.__send(404, {"error": "not found"})
+
+    def __send(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubSlack(StubServer):
+    def __init__(self, port: int = 0, latency: float = 0.0):
+        super().__init__(_SlackHandler, port)
+        self.latency = latency
+
+        self.__messages = defaultdict(list)
+        self.__condition = threading.Condition()
+
+    @property
+    def api_url(self):
+        return self.url + "/api/"
+
+    def response_url(self, flow_id: str):
+        return f"{self.url}/response/{flow_id}"
+
+    def record(self, flow_id: str, message: dict):
+        with self.__condition:
+            self.__messages[flow_id].append(message)
+            self.__condition.notify_all()
+
+    def wait_for(self, flow_id: str, count: int, timeout: float):
+        # Waits until the flow has had count messages posted to its response_url, returning the last
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while len(self.__messages[flow_id]) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No response for {flow_id} after {timeout}s")
+                self.__condition.wait(remaining)
+            return self.__messages[flow_id][count - 1]
+
+    def forget(self, flow_id: str):
+        with self.__condition:
+            self.__messages.pop(flow_id, None)
+
+
+class _SlackHandler(BaseHTTPRequestHandler):
+    AUTH_TEST = {"ok": True, "url": "https://stub.slack.com/", "team": "Stub", "user": "tenor", "team_id": "T0STUB",
+                 "user_id": "U0STUB", "bot_id": "B0STUB", "is_enterprise_install": False}
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+
+        if path.startswith("/response/"):
+            time.sleep(stub.latency)
+            stub.record(path[len("/response/"):], json.loads(body or b"{}"))
+            self.__send(200, b"ok", "text/plain")
+        elif path.endswith("/auth.test"):
+            self.__send(200, json.dumps(_SlackHandler.AUTH_TEST).encode(), "application/json")
+        else:
+            # Any other web API method, which the bot doesn't use
+            self.__send(200, json.dumps({"ok": True}).encode(), "application/json")
+
+    def __send(self, status: int, content: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubDatabase(StubServer):
+    STREAM_TIMEOUT = 10
+
+    def __init__(self, path: str, port: int = 0, latency: float = 0.0):
+        super().__init__(_DatabaseHandler, port)
+        self.path = path
+        self.latency = latency
+
+        self.pipelines = 0
+        # baton: (connection, last used). Each stream is one connection, so transactions can span requests
+        # Batons are single use, so a stream is only ever used by one request at a time
+        self.__streams = {}
+        self.__lock = threading.Lock()
+
+    def open_stream(self, baton):
+        with self.__lock:
+            self.__expire_streams()
+            if baton is None:
+                connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                connection.execute("PRAGMA journal_mode = WAL")
+                connection.execute("PRAGMA busy_timeout = 5000")
+                return connection
+
+            stream = self.__streams.pop(baton, None)
+            return None if stream is None else stream[0]
+
+    def keep_stream(self, connection):
+        baton = secrets.token_urlsafe(16)
+        with self.__lock:
+            self.__streams[baton] = (connection, time.monotonic())
+        return baton
+
+    def __expire_streams(self):
+        # Like sqld, abandoned streams are closed (rolling back any transaction) after a while
+        cutoff = time.monotonic() - StubDatabase.STREAM_TIMEOUT
+        for baton, (connection, last_used) in list(self.__streams.items()):
+            if last_used < cutoff:
+                del self.__streams[baton]
+                connection.close()
+
+
+class _DatabaseHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if urlparse(self.path).path != "/v2/pipeline":
+            self.__send(404, {"error": "not found"})
+            return
+
+        time.sleep(stub.latency)
+        connection = stub.open_stream(body.get("baton"))
+        if connection is None:
+            self.__send(400, {"error": "Stream expired or baton invalid"})
+            return
+
+        stub.pipelines += 1
+        closed = False
+        results = []
+        for request in body.get("requests", []):
+            if request["type"] == "close":
+                closed = True
+                results.append({"type": "ok", "response": {"type": "close"}})
+            else:
+                results.append(self.__execute(connection, request["stmt"]))
+
+        if closed:
+            connection.close()
+            baton = None
+        else:
+            baton = stub.keep_stream(connection)
+        self.__send(200, {"baton": baton, "base_url": None, "results": results})
+
+    @staticmethod
+    def __execute(connection: sqlite3.Connection, stmt: dict):
+        try:
+            cursor = connection.execute(stmt["sql"], [_DatabaseHandler.__decode(arg) for arg in stmt.get("args", [])])
+            rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            code = getattr(e, "sqlite_errorname", "SQLITE_ERROR")
+            return {"type": "error", "error": {"message": str(e), "code": code}}
+
+        return {"type": "ok", "response": {"type": "execute", "result": {
+            "cols": [{"name": column[0], "decltype": None} for column in cursor.description or []],
+            "rows": [[_DatabaseHandler.__encode(value) for value in row] for row in rows],
+            "affected_row_count": max(cursor.rowcount, 0),
+            "last_insert_rowid": None if cursor.lastrowid is None else str(cursor.lastrowid)
+        }}}
+
+    @staticmethod
+    def __decode(arg: dict):
+        return {
+            "null": lambda: None,
+            "integer": lambda: int(arg["value"]),
+            "float": lambda: float(arg["value"]),
+            "text": lambda: arg["value"],
+            "blob": lambda: base64.b64decode(arg["base64"])
+        }[arg["type"]]()
+
+    @staticmethod
+    def __encode(value):
+        if value is None:
+            return {"type": "null"}
+        if isinstance(value, int):
+            return {"type": "integer", "value": str(value)}
+        if isinstance(value, float):
+            return {"type": "float", "value": value}
+        if isinstance(value, bytes):
+            return {"type": "blob", "base64": base64.b64encode(value).decode()}
+        return {"type": "text", "value": value}
+
+    def __send(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run stub tenor and slack servers")
+    parser.add_argument("--tenor-port", default=8081, type=int)
+    parser.add_argument("--slack-port", default=8082, type=int)
+    parser.add_argument("--tenor-latency", default=0.05, type=float,
+                        help="Seconds tenor takes to respond")
+    parser.add_argument("--tenor-jitter", default=0.0, type=float,
+                        help="Seconds tenor's latency varies by either way")
+    parser.add_argument("--tenor-result-bytes", default=2000, type=int,
+                        help="Approximate size of each result object")
+    parser.add_argument("--tenor-error-rate", default=0.0, type=float,
+                        help="Fraction of tenor requests that fail with a 503")
+    parser.add_argument("--slack-latency", default=0.0, type=float,
+                        help="Seconds slack takes to accept a response")
+    parser.add_argument("--database-port", default=0, type=int,
+                        help="Also serve a SQLite file over libSQL's HTTP protocol on this port (0 to disable)")
+    parser.add_argument("--database-file", default="stub_database.db",
+                        help="SQLite file served with --database-port")
+    parser.add_argument("--database-latency", default=0.0, type=float,
+                        help="Seconds the database server takes to respond to each request")
+    args = parser.parse_args()
+
+    tenor = StubTenor(args.tenor_port, args.tenor_latency, args.tenor_jitter, args.tenor_result_bytes,
+                      args.tenor_error_rate).start()
+    slack = StubSlack(args.slack_port, args.slack_latency).start()
+    print(f"Stub tenor: --tenor-url {tenor.url}")
+    print(f"Stub slack: --slack-api-url {slack.api_url}")
+    if args.database_port > 0:
+        database = StubDatabase(args.database_file, args.database_port, args.database_latency).start()
+        print(f"Stub database: --database {database.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,43 @@
 from image import Image
+from metrics import Histogram, Metrics
 
 class BlockResults:
-    def __init__(self, block_uid: str, image: Image, user_id: str, query_str: str):
+    SMALL_PREVIEWS = False
+    GRID_SIZE = 1
+    MAX_GRID_SIZE = 10
+
+    # Grid send buttons each need their own block, identified as <block_uid>/<index>
+    BLOCK_ID_SEPARATOR = "/"
+
+    RENDER_TIMER = Histogram("blockkit_seconds", "Time taken to build block kit messages", ("message",))
+
+    def __init__(self, block_uid: str, image: Image, user_id: str, query_str: str, choices: list = None):
         self.user_id = user_id
         self.image = image
         self.block_uid = block_uid
         self.query_str = query_str
+        # (tenor_result id, Image) pairs shown as a grid, each with their own send button
+        self.choices = choices
+
+    @staticmethod
+    def block_uid_of(block_id: str):
+        return block_id.split(BlockResults.BLOCK_ID_SEPARATOR, 1)[0]
 
+    @Metrics.timed(RENDER_TIMER, "ephemeral")
     def get_ephemeral_message(self):
+        if self.choices is not None:
+            return self.__get_grid()
+
         return [
-            self.__get_image(add_description=True),
+            self.__get_image(self.image, add_description=True, small=BlockResults.SMALL_PREVIEWS),
             self.__get_action_buttons()
         ]
 
+    @Metrics.timed(RENDER_TIMER, "post")
     def get_command_post_message(self):
         return [
             self.__get_user_posted_section(),
-            self.__get_image()
+            self.__get_image(self.image)
         ]
 
     def __get_user_posted_section(self):
@@ -28,19 +49,37 @@ class BlockResults:
             },
         }
 
-    def __get_image(self, add_description=False):
-        description = self.image.get_description()
-        description = BlockResults.__strip_end(description, " GIF")
+    def __get_grid(self):
+        # Always small previews, as several are shown at once
+        blocks = []
+        for i, (result_id, image) in enumerate(self.choices):
+            blocks.append(self.__get_image(image, add_description=True, small=True))
+            blocks.append({
+                "type": "actions",
+                "block_id": f"{self.block_uid}{BlockResults.BLOCK_ID_SEPARATOR}{i}",
+                "elements": [self.__get_button("Send", "action_send", str(result_id), style="primary")]
+            })
+        blocks.append({
+            "type": "actions",
+            "block_id": self.block_uid,
+            "elements": [
+                self.__get_button("Next", "action_next", "Next"),
+                self.__get_button("Cancel", "action_cancel", "Cancel")
+            ]
+        })
+        return blocks
 
+    @staticmethod
+    def __get_image(image: Image, add_description=False, small=False):
         ret = {
             "type": "image",
-            "image_url": self.image.get_url(),
-            "alt_text": description
+            "image_url": image.small_url if small else image.url,
+            "alt_text": image.title
         }
         if add_description:
             ret["title"] = {
                 "type": "plain_text",
-                "text": description
+                "text": image.title
             }
 
         return ret
@@ -50,42 +89,24 @@ class BlockResults:
             "type": "actions",
             "block_id": self.block_uid,
             "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Send",
-                        "emoji": True
-                    },
-                    "style": "primary",
-                    "value": "Send",
-                    "action_id": "action_send"
-                },
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Next",
-                        "emoji": True
-                    },
-                    "value": "Next",
-                    "action_id": "action_next"
-                },
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Cancel",
-                        "emoji": True
-                    },
-                    "value": "Cancel",
-                    "action_id": "action_cancel"
-                }
+                self.__get_button("Send", "action_send", "Send", style="primary"),
+                self.__get_button("Next", "action_next", "Next"),
+                self.__get_button("Cancel", "action_cancel", "Cancel")
             ]
         }
 
     @staticmethod
-    def __strip_end(text, suffix):
-        if text.upper().endswith(suffix.upper()):
-            return text[:-len(suffix)]
-        return text
\ No newline at end of file
+    def __get_button(text: str, action_id: str, value: str, style: str = None):
+        button = {
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": text,
+                "emoji": True
+            },
+            "value": value,
+            "action_id": action_id
+        }
+        if style is not None:
+            button["style"] = style
+        return button
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, message: str, retry_in: float):
+        super().__init__(message)
+        # Seconds until the breaker will let a call through again
+        self.retry_in = retry_in
+
+"""Stops calling a failing dependency for a while. Opens after failure_threshold consecutive failures, then once
+reset_timeout seconds have passed lets up to half_open_calls probe requests through. If they all succeed the
+circuit closes again, and if any fail it re-opens. Probes that never report back are given up on after reset_timeout"""
+class CircuitBreaker:
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, half_open_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+
+        self.state = CircuitBreaker.CLOSED
+        self.__failures = 0
+        self.__opened_at = 0
+        self.__probes = 0
+        self.__probe_successes = 0
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        if self.failure_threshold <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.__lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if now - self.__opened_at < self.reset_timeout:
+                return self.state == CircuitBreaker.HALF_OPEN and self.__take_probe()
+
+            # Opened long enough ago (or the probes went missing), so start probing again
+            self.__opened_at = now
+            self.__probes = 0
+            self.__probe_successes = 0
+            self.__set_state(CircuitBreaker.HALF_OPEN)
+            return self.__take_probe()
+
+    def retry_in(self):
+        # Seconds until allow may let a call through again (probes that never report back are given up on too)
+        if self.state == CircuitBreaker.CLOSED:
+            return 0
+        with self.__lock:
+            return max(0.0, self.__opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        with self.__lock:
+            self.__failures = 0
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.__probe_successes += 1
+                if self.__probe_successes >= self.half_open_calls:
+                    self.__set_state(CircuitBreaker.CLOSED)
+
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    (self.state == CircuitBreaker.CLOSED and self.__failures >= self.failure_threshold):
+                self.__opened_at = time.monotonic()
+                self.__set_state(CircuitBreaker.OPEN)
+
+    def __take_probe(self):
+        if self.__probes >= self.half_open_calls:
+            return False
+        self.__probes += 1
+        return True
+
+    def __set_state(self, state: str):
+        if state != self.state:
+            log = logging.warning if state == CircuitBreaker.OPEN else logging.info
+            log("Circuit breaker for %s changed from %s to %s", self.name, self.state, state)
+            self.state = state
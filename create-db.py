@@ -1,45 +1,32 @@
-import os
-import sqlite3
+import argparse
+import logging
+import sys
 
-if os.path.exists("database.db"):
-    os.remove("database.db")
-    print("Destroyed previous DB")
-db = sqlite3.connect("database.db")
+from database import Database
+from migrations import Migrations
+from queries import Queries
 
-# Create tables
-# language=SQL
-db.execute("""
-CREATE TABLE slack_request (
-    id              INTEGER     NOT NULL CONSTRAINT pk_slack_request PRIMARY KEY AUTOINCREMENT,
-    timestamp       TEXT        NOT NULL,
-    user_id         TEXT        NOT NULL,
-    conversation_id TEXT        NOT NULL,
-    block_uid       TEXT        NOT NULL,
-    search_string   TEXT        NOT NULL,
-    status          TEXT        NOT NULL,
-    
-    CONSTRAINT uk_slack_request_block_uid UNIQUE (block_uid),
-    CONSTRAINT ck_slack_request_status CHECK (status IN ('SELECTING', 'CANCELLED', 'POSTED'))
-)
-""")
+parser = argparse.ArgumentParser(description="Create or migrate the database in place")
+parser.add_argument("--check-plans", action="store_true",
+                    help="After migrating, check every query the code runs uses an index (EXPLAIN QUERY PLAN)")
+parser.add_argument("--database", default=str(Database.BACKEND),
+                    help="SQLite file, or the URL of a libSQL server")
+parser.add_argument("--database-auth-token", default=None,
+                    help="Token to authenticate with the libSQL server, if --database is one")
+args = parser.parse_args()
 
-# language=SQL
-db.execute("""
-CREATE TABLE tenor_result (
-    id                  INTEGER     NOT NULL CONSTRAINT pk_tenor_result PRIMARY KEY AUTOINCREMENT,
-    slack_request_id    INTEGER     NOT NULL,
-    position            INTEGER     NOT NULL,
-    gif_object          TEXT        NOT NULL,
-    status              TEXT        NOT NULL,
-    next_pos            TEXT        NULL,
-    
-    CONSTRAINT uk_tenor_result_slack_request_order UNIQUE (slack_request_id, position),      
-    CONSTRAINT fk_tenor_result_slack_request FOREIGN KEY (slack_request_id) REFERENCES slack_request (id),
-    CONSTRAINT ck_tenor_result_status CHECK (status IN ('FETCHED', 'SELECTING', 'USED'))
-)
-""")
+logging.basicConfig(level=logging.INFO)
+Database.configure(args.database, args.database_auth_token)
 
-db.commit()
-db.close()
+Migrations.migrate()
+print(f"Database at schema version {len(Migrations.MIGRATIONS)}")
 
-print("Database created")
+if args.check_plans:
+    problems = Migrations.check_query_plans()
+    for name, detail in problems:
+        print(f"Query '{name}' does not use an index: {detail}")
+    if problems:
+        sys.exit(1)
+    print(f"All {len(Queries.all())} queries use an index")
+
+Database.close_all()
@@ -1,14 +1,127 @@
+import logging
 import sqlite3
+import threading
+import time
+from queue import Empty, LifoQueue
 
+from metrics import Histogram, Metrics
+
+"""Opens connections to a local SQLite file, tuned for a single node"""
+class SqliteBackend:
+    BUSY_TIMEOUT_MS = 5000
+    # Whether other nodes may be changing the same database
+    SHARED = False
+
+    def __init__(self, path: str = "database.db"):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def connect(self):
+        # Connections are handed between worker threads, but the pool guarantees only one uses it at a time
+        # Writers take the lock when their transaction begins, instead of failing to upgrade a read lock later
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level="IMMEDIATE")
+        connection.row_factory = sqlite3.Row
+
+        # Pragmas are per connection, so only need setting when the connection is first opened
+        # auto_vacuum only takes effect on a new database, or once an existing one has been vacuumed (janitor.py --vacuum)
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(f"PRAGMA busy_timeout = {int(SqliteBackend.BUSY_TIMEOUT_MS)}")
+        return connection
+
+"""Context manager handing out connections from a bounded, process wide pool
+Connections are kept warm between uses, and are only ever used by one thread at a time
+They come from BACKEND, a local SQLite file by default (see configure)"""
 class Database:
-    __DATABASE_FILE = "database.db"
+    BACKEND = SqliteBackend()
+
+    POOL_SIZE = 10
+    POOL_TIMEOUT = 30
+
+    WAIT_TIMER = Histogram("database_wait_seconds", "Time spent waiting for a pooled database connection")
+    HELD_TIMER = Histogram("database_seconds", "Time a database connection is in use for, including the commit")
+
+    __pool = LifoQueue()
+    __pool_lock = threading.Lock()
+    __connection_count = 0
 
     def __enter__(self):
-        self.connection = sqlite3.connect(Database.__DATABASE_FILE)
-        self.connection.row_factory = sqlite3.Row
+        started = time.perf_counter() if Metrics.ENABLED else None
+        self.connection = Database.__acquire()
+
+        self.__acquired = None
+        if started is not None:
+            self.__acquired = time.perf_counter()
+            Database.WAIT_TIMER.observe(self.__acquired - started)
         return self.connection
 
     def __exit__(self, *exc_info):
-        self.connection.__exit__(*exc_info)
-        self.connection.close()
+        try:
+            self.connection.__exit__(*exc_info)
+        finally:
+            Database.__release(self.connection)
+            if self.__acquired is not None:
+                Database.HELD_TIMER.observe(time.perf_counter() - self.__acquired)
+
+    @staticmethod
+    def configure(url: str, auth_token: str = None):
+        # A path (or sqlite:// URL) for a local SQLite file, or the URL of a libSQL server shared by several nodes
+        Database.close_all()
+        if url.startswith(("http://", "https://", "libsql://")):
+            # Imported here, as only the networked backend needs it
+            from remote_database import RemoteBackend
+            Database.BACKEND = RemoteBackend(url, auth_token)
+        else:
+            Database.BACKEND = SqliteBackend(url.removeprefix("sqlite://"))
+        logging.info("Using database %s", Database.BACKEND)
+
+    @staticmethod
+    def close_all():
+        with Database.__pool_lock:
+            while True:
+                try:
+                    connection = Database.__pool.get_nowait()
+                except Empty:
+                    break
+                connection.close()
+                Database.__connection_count -= 1
+
+    @staticmethod
+    def __acquire():
+        try:
+            return Database.__pool.get_nowait()
+        except Empty:
+            pass
+
+        with Database.__pool_lock:
+            create = Database.__connection_count < Database.POOL_SIZE
+            if create:
+                Database.__connection_count += 1
+
+        if create:
+            try:
+                return Database.__connect()
+            except Exception:
+                with Database.__pool_lock:
+                    Database.__connection_count -= 1
+                raise
+
+        try:
+            return Database.__pool.get(timeout=Database.POOL_TIMEOUT)
+        except Empty:
+            raise sqlite3.DatabaseError(f"Timed out after {Database.POOL_TIMEOUT}s waiting for a database connection")
+
+    @staticmethod
+    def __release(connection: sqlite3.Connection):
+        if connection.in_transaction:
+            connection.rollback()
+        Database.__pool.put(connection)
 
+    @staticmethod
+    def __connect():
+        connection = Database.BACKEND.connect()
+        logging.info("Opened database connection %s/%s", Database.__connection_count, Database.POOL_SIZE)
+        return connection
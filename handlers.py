@@ -0,0 +1,227 @@
+import functools
+import logging
+import uuid
+from datetime import datetime
+from sqlite3 import DatabaseError
+
+from slack_bolt import App
+from slack_sdk import WebClient
+
+from blockresults import BlockResults
+from circuitbreaker import CircuitOpenError
+from database import Database
+from metrics import SESSIONS, Histogram, Metrics
+from offload import Offload
+from posted_index import PostedIndex
+from queries import Queries
+from ratelimit import RateLimitedError
+from session_store import SessionStore
+from tenor_search import Tenor
+
+"""Slack listeners, shared by the threaded App and the asyncio AsyncApp (see async_app.py)
+They're coroutines, awaiting ack/respond and Tenor, with database work going through Offload. The async app
+registers them as they are, and the threaded app runs each on its own worker thread (see threaded)"""
+
+ERROR_MESSAGE = "Encountered an error processing request. Please contact AgentKay for help"
+BUSY_MESSAGE = "Tenor is busy right now and there are no earlier results to show, please try again in a few seconds"
+
+HANDLER_TIMER = Histogram("handler_seconds", "Time taken by each slack listener, including responding", ("handler",))
+RESPOND_TIMER = Histogram("slack_respond_seconds", "Time taken by slack to accept each response", ("handler",))
+
+def create_app(token: str, signing_secret: str, api_url: str = None):
+    if api_url is None:
+        app = App(token=token, signing_secret=signing_secret)
+    else:
+        # Eg. to point at the stub server in benchmark/
+        app = App(client=WebClient(token=token, base_url=api_url), signing_secret=signing_secret)
+    app.error(error_handler)
+    app.command(command="/tenor")(threaded(tenor_search))
+    app.action("action_send")(threaded(send_message))
+    app.action("action_next")(threaded(next_message))
+    app.action("action_cancel")(threaded(delete_message))
+    return app
+
+def error_handler(error, body, logger, respond):
+    logger.exception("Error: %s", error)
+    logger.info("Request body: %s", body)
+
+    if respond is not None:
+        respond(error_message(error), replace_original=False, response_type="ephemeral")
+
+def error_message(error):
+    # Our own rate limit or circuit breaker refusing a click (with no fallback results) passes by itself
+    if isinstance(error, (RateLimitedError, CircuitOpenError)):
+        return BUSY_MESSAGE
+    return ERROR_MESSAGE
+
+def threaded(listener):
+    # Bolt's threaded app calls listeners on its worker threads with sync ack/respond, so the listener is run to
+    # completion there. Bolt reads the arguments it passes from the (unwrapped) listener, and passes them by name
+    @functools.wraps(listener)
+    def wrapper(ack, respond, **kwargs):
+        return Offload.run(listener(ack=awaitable(ack), respond=awaitable(respond), **kwargs))
+    return wrapper
+
+def awaitable(fn):
+    async def call(*args, **kwargs):
+        return fn(*args, **kwargs)
+    return call
+
+def instrumented(name: str):
+    # Times the listener, and each respond call it makes
+    def decorate(listener):
+        @functools.wraps(listener)
+        async def wrapper(ack, respond, **kwargs):
+            if not Metrics.ENABLED:
+                return await listener(ack=ack, respond=respond, **kwargs)
+
+            async def timed_respond(*args, **respond_kwargs):
+                with RESPOND_TIMER.time(name):
+                    return await respond(*args, **respond_kwargs)
+
+            with HANDLER_TIMER.time(name):
+                return await listener(ack=ack, respond=timed_respond, **kwargs)
+        return wrapper
+    return decorate
+
+async def selection_results(tenor: Tenor, block_uid: str, user_id: str, query_str: str):
+    # Moves on to the next image, or the next grid of them
+    if BlockResults.GRID_SIZE > 1:
+        choices = await tenor.next_images(BlockResults.GRID_SIZE)
+        return BlockResults(block_uid, choices[0][1], user_id, query_str, choices)
+    return BlockResults(block_uid, await tenor.next_image(), user_id, query_str)
+
+def has_posted_gifs(conversation_id: str, user_id: str, modifier: tuple):
+    with Database() as db:
+        request = {"conversation_id": conversation_id, "user_id": user_id}
+        return len(PostedIndex.lookup(db, request, *modifier, 0, 1)) > 0
+
+def create_request(block_uid: str, user_id: str, conversation_id: str, query_str: str):
+    with Database() as db:
+        now = datetime.now().isoformat()
+        cursor = db.execute(Queries.CREATE_REQUEST, (
+            now,
+            user_id,
+            conversation_id,
+            block_uid,
+            query_str,
+            now
+        ))
+        if cursor.rowcount != 1:
+            raise DatabaseError(f"Error creating record. Rowcount: {cursor.rowcount}")
+
+def post_request(block_uid: str, request, image):
+    # Only posted if still being selected, as eg. the janitor may have expired it since the request was read
+    # Returns None if posted, otherwise the request as it is now
+    with Database() as db:
+        if db.execute(Queries.POST_REQUEST, (block_uid,)).rowcount == 1:
+            PostedIndex.record(db, request, image)
+            return None
+    return fetch_request(block_uid)
+
+def cancel_request(block_uid: str):
+    # Same as post_request, so a search the janitor expired isn't also counted as cancelled
+    with Database() as db:
+        if db.execute(Queries.CANCEL_REQUEST, (block_uid,)).rowcount == 1:
+            return None
+    return fetch_request(block_uid)
+
+def fetch_request(block_uid: str):
+    with Database() as db:
+        request = db.execute(Queries.FETCH_REQUEST, (block_uid,)).fetchone()
+        if request is None:
+            raise DatabaseError(f"No request stored for {block_uid}")
+        return request
+
+async def still_selecting(request, respond):
+    # Eg. the janitor expired the request, or a send/cancel click was handled first
+    if request['status'] == 'SELECTING':
+        return True
+
+    logging.info("Ignoring action for request %s with status %s", request['block_uid'], request['status'])
+    await respond("This search has expired, please run /tenor again", replace_original=True,
+                  response_type="ephemeral")
+    return False
+
+@instrumented("search")
+async def tenor_search(ack, respond, command):
+    conversation_id = command['channel_id']
+    conversation = command['channel_name']
+    user_id = command['user_id']
+    username = command['user_name']
+    query_str = command['text']
+
+    block_uid = str(uuid.uuid4())
+    logging.info("Received new request %s from user '%s' (%s) in channel '%s' (%s). Query: %s",
+                 block_uid, username, user_id, conversation, conversation_id, query_str)
+    await ack()
+
+    modifier = PostedIndex.parse(query_str)
+    if modifier is not None and not await Offload.call(has_posted_gifs, conversation_id, user_id, modifier):
+        await respond(f"Nothing posted yet for /tenor {query_str}", response_type="ephemeral")
+        return
+
+    await Offload.call(create_request, block_uid, user_id, conversation_id, query_str)
+
+    results = await selection_results(Tenor(block_uid), block_uid, user_id, query_str)
+    await respond(blocks=results.get_ephemeral_message(), response_type="ephemeral")
+
+@instrumented("send")
+async def send_message(ack, respond, action):
+    block_uid = BlockResults.block_uid_of(action.get('block_id'))
+    # Grid send buttons carry the id of the result they're for
+    value = action.get('value', '')
+    result_id = int(value) if value.isdigit() else None
+    logging.info("Received send request for %s (result %s)", block_uid, result_id)
+    await ack()
+
+    tenor = Tenor(block_uid)
+    request = await tenor.fetch_request()
+    if not await still_selecting(request, respond):
+        return
+
+    image = await tenor.get_send_image_and_delete_others(result_id)
+
+    current = await Offload.call(post_request, block_uid, request, image)
+    if current is not None:
+        await still_selecting(current, respond)
+        return
+
+    logging.info("Set message %s as posted", block_uid)
+    SESSIONS.inc("POSTED")
+    results = BlockResults(block_uid, image, request['user_id'], request['search_string'])
+    await respond(blocks=results.get_command_post_message(), response_type="in_channel", delete_original=True)
+
+    # Gifs found in the posted index weren't from a tenor search, so there's no query to register them against
+    if PostedIndex.parse(request['search_string']) is None:
+        await tenor.register_image_as_shared(image)
+
+@instrumented("next")
+async def next_message(ack, respond, action):
+    block_uid = BlockResults.block_uid_of(action.get('block_id'))
+    logging.info("Received next request for %s", block_uid)
+    await ack()
+
+    tenor = Tenor(block_uid)
+    request = await tenor.fetch_request()
+    if not await still_selecting(request, respond):
+        return
+
+    results = await selection_results(tenor, block_uid, request['user_id'], request['search_string'])
+    await respond(blocks=results.get_ephemeral_message(), response_type="ephemeral")
+
+@instrumented("cancel")
+async def delete_message(ack, respond, action):
+    block_uid = BlockResults.block_uid_of(action.get('block_id'))
+    logging.info("Received cancel request for %s", block_uid)
+    await ack()
+
+    current = await Offload.call(cancel_request, block_uid)
+    SessionStore.discard(block_uid)
+    if current is not None:
+        await still_selecting(current, respond)
+        return
+
+    await respond(delete_original=True)
+    logging.info("Deleted message %s", block_uid)
+    SESSIONS.inc("CANCELLED")
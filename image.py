@@ -1,21 +1,61 @@
 import logging
 
+"""Value object for a single tenor result, built once when the result is fetched
+Renditions are picked at ingest, so rendering is attribute access only"""
 class Image:
     MAX_IMAGE_SIZE = 2 * (1024**2)
+    SMALL_IMAGE_SIZE = 512 * 1024
 
-    def __init__(self, image_json):
-        self.__json = image_json
+    __slots__ = ("id", "description", "title", "url", "size", "small_url", "small_size")
 
-    def get_description(self):
-        return self.__json['content_description']
+    def __init__(self, tenor_id: str, description: str, url: str, size: int, small_url: str = None,
+                 small_size: int = None):
+        self.id = tenor_id
+        self.description = description
+        self.title = Image.__strip_end(description, " GIF")
+        self.url = url
+        self.size = size
+        self.small_url = url if small_url is None else small_url
+        self.small_size = size if small_url is None else small_size
 
-    def get_id(self):
-        return self.__json['id']
+    @staticmethod
+    def from_tenor(image_json):
+        # Only the fields the bot uses are kept, so the rest of the tenor object can be dropped at ingest
+        gifs = [(k, v) for (k, v) in image_json['media'][0].items() if k.endswith('gif')]
+        if not gifs:
+            raise ValueError(f"No gif renditions for image {image_json['id']}")
 
-    def get_url(self):
-        media = self.__json['media'][0]
-        items = {k: v for (k, v) in media.items() if v['size'] < Image.MAX_IMAGE_SIZE and k.endswith('gif')}
-        item = sorted(items.items(), key=lambda it: -it[1]['size'])[0]
+        kind, item = Image.__choose_rendition(gifs, Image.MAX_IMAGE_SIZE)
+        small_kind, small_item = Image.__choose_rendition(gifs, Image.SMALL_IMAGE_SIZE)
 
-        logging.info(f"Selected type: {item[0]} of size {item[1]['size']:,} bytes")
-        return item[1]['url']
+        logging.debug("Selected type: %s of size %s bytes (small: %s of size %s bytes) for image %s",
+                      kind, item['size'], small_kind, small_item['size'], image_json['id'])
+        return Image(image_json['id'], image_json['content_description'], item['url'], item['size'],
+                     small_item['url'], small_item['size'])
+
+    @staticmethod
+    def from_db(row):
+        return Image(row['tenor_id'], row['description'], row['gif_url'], row['gif_size'], row['small_gif_url'],
+                     row['small_gif_size'])
+
+    @staticmethod
+    def __choose_rendition(gifs: list, budget: int):
+        # Largest rendition within budget, falling back to the smallest available if none are
+        best = None
+        smallest = None
+        for kind, item in gifs:
+            if item['size'] < budget and (best is None or item['size'] > best[1]['size']):
+                best = (kind, item)
+            if smallest is None or item['size'] < smallest[1]['size']:
+                smallest = (kind, item)
+
+        if best is None:
+            logging.warning("No gif rendition under %s bytes, using smallest of %s bytes", budget, smallest[1]['size'])
+            return smallest
+        return best
+
+    @staticmethod
+    def __strip_end(text, suffix):
+        if text.upper().endswith(suffix.upper()):
+            return text[:-len(suffix)]
+        return text
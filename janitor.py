@@ -0,0 +1,135 @@
+import argparse
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database import Database
+from metrics import SESSIONS
+from queries import Queries
+from session_store import SessionStore
+
+"""Expires requests left in SELECTING with no clicks for IDLE_TTL seconds (the user never pressed send/cancel), and
+removes the unused results of finished requests (eg. stored by a prefetch that completed after the request was sent).
+Work is done in small batches, each its own transaction, so the write lock is only ever held briefly. Runs
+periodically inside the bot, or once from the command line"""
+class Janitor:
+    IDLE_TTL = 3600
+    BATCH_SIZE = 500
+    INTERVAL = 600
+    VACUUM_PAGES = 1000
+
+    __thread = None
+    __stopping = threading.Event()
+
+    @staticmethod
+    def start():
+        if Janitor.__thread is not None:
+            return
+
+        Janitor.__stopping.clear()
+        Janitor.__thread = threading.Thread(target=Janitor.__loop, name="Janitor", daemon=True)
+        Janitor.__thread.start()
+        logging.info("Started janitor, expiring requests idle for %ss every %ss", Janitor.IDLE_TTL, Janitor.INTERVAL)
+
+    @staticmethod
+    def stop(timeout: float = None):
+        if Janitor.__thread is None:
+            return
+
+        Janitor.__stopping.set()
+        Janitor.__thread.join(timeout)
+        Janitor.__thread = None
+
+    @staticmethod
+    def run_once():
+        cutoff = (datetime.now() - timedelta(seconds=Janitor.IDLE_TTL)).isoformat()
+        expired = Janitor.__in_batches(Janitor.__expire_requests, cutoff)
+        SESSIONS.inc("EXPIRED", amount=expired)
+        Janitor.__in_batches(Janitor.__retire_selected_results)
+        deleted = Janitor.__in_batches(Janitor.__delete_abandoned_results)
+        reclaimed = Janitor.__incremental_vacuum()
+
+        logging.info("Janitor expired %s requests, deleted %s unused results and reclaimed %s bytes",
+                     expired, deleted, reclaimed)
+        return expired, deleted, reclaimed
+
+    @staticmethod
+    def vacuum():
+        # Full vacuum, needed once to switch an existing database over to incremental auto vacuum
+        with Database() as db:
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("VACUUM")
+        logging.info("Vacuumed database")
+
+    @staticmethod
+    def __loop():
+        while not Janitor.__stopping.wait(Janitor.INTERVAL):
+            try:
+                Janitor.run_once()
+            except Exception:
+                logging.exception("Error running janitor")
+
+    @staticmethod
+    def __in_batches(fn, *args):
+        total = 0
+        while not Janitor.__stopping.is_set():
+            with Database() as db:
+                count = fn(db, *args)
+            total += count
+            if count < Janitor.BATCH_SIZE:
+                break
+        return total
+
+    @staticmethod
+    def __expire_requests(db, cutoff: str):
+        rows = db.execute(Queries.EXPIRE_REQUESTS, (cutoff, Janitor.BATCH_SIZE)).fetchall()
+        # Dropped from memory, so a later click reloads the request and sees it has expired
+        for row in rows:
+            SessionStore.discard(row['block_uid'])
+        return len(rows)
+
+    @staticmethod
+    def __retire_selected_results(db):
+        return db.execute(Queries.RETIRE_EXPIRED_RESULTS, (Janitor.BATCH_SIZE,)).rowcount
+
+    @staticmethod
+    def __delete_abandoned_results(db):
+        return db.execute(Queries.DELETE_ABANDONED_RESULTS, (Janitor.BATCH_SIZE,)).rowcount
+
+    @staticmethod
+    def __incremental_vacuum():
+        with Database() as db:
+            if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logging.info("Incremental vacuum not enabled for database, run janitor.py --vacuum to enable it")
+                return 0
+
+            page_size = db.execute("PRAGMA page_size").fetchone()[0]
+            before = db.execute("PRAGMA freelist_count").fetchone()[0]
+            db.execute(f"PRAGMA incremental_vacuum({int(Janitor.VACUUM_PAGES)})").fetchall()
+            after = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (before - after) * page_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expire abandoned requests and remove their unused results")
+    parser.add_argument("--idle-ttl", default=Janitor.IDLE_TTL, type=int,
+                        help="Seconds without a click after which a request still being selected is expired")
+    parser.add_argument("--batch-size", default=Janitor.BATCH_SIZE, type=int,
+                        help="Maximum rows changed per transaction")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Run a full vacuum first, enabling incremental vacuum on an existing database")
+    parser.add_argument("--database", default=str(Database.BACKEND),
+                        help="SQLite file, or the URL of a libSQL server")
+    parser.add_argument("--database-auth-token", default=None,
+                        help="Token to authenticate with the libSQL server, if --database is one")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    Database.configure(args.database, args.database_auth_token)
+    Janitor.IDLE_TTL = args.idle_ttl
+    Janitor.BATCH_SIZE = args.batch_size
+
+    if args.vacuum:
+        Janitor.vacuum()
+    Janitor.run_once()
+    Database.close_all()
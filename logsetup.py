@@ -1,5 +1,11 @@
+import atexit
+import gzip
+import json
 import logging
+import shutil
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from queue import SimpleQueue
 import sys
 import os
 
@@ -8,6 +14,10 @@ Requires %(message)s to be the last thing"""
 class CustMultiLineFormatter(logging.Formatter):
     """Adapted from logging.Formatter"""
     def format(self, record: logging.LogRecord):
+        # Each handler formats the same record, so reuse the result if we've already done it
+        if record.__dict__.get("cust_formatter") is self:
+            return record.cust_formatted
+
         # Change it so we save the initial string (without extras), and are not reliant on implementation
         record.message = record.getMessage()
         msg = record.message
@@ -31,31 +41,76 @@ class CustMultiLineFormatter(logging.Formatter):
             s = s + self.formatStack(record.stack_info)
 
         # Replace newlines with indentation
-        header_length = 0
-        if initial_str.endswith(msg):
-            header_length = len(initial_str) - len(msg)
-        replace_str = '\n' + ' ' * header_length
-        if header_length >= 2:
-            replace_str = replace_str[:-2] + '| '
-        s = s.replace('\n', replace_str)
+        if '\n' in s:
+            header_length = 0
+            if initial_str.endswith(msg):
+                header_length = len(initial_str) - len(msg)
+            replace_str = '\n' + ' ' * header_length
+            if header_length >= 2:
+                replace_str = replace_str[:-2] + '| '
+            s = s.replace('\n', replace_str)
 
+        record.cust_formatter = self
+        record.cust_formatted = s
         return s
 
+"""Formatter writing each record as a compact JSON object on its own line"""
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+"""Queues records for a QueueListener, leaving formatting (including tracebacks) to the listener's thread
+Arguments are merged into the message here though, as they could change once the logging call returns"""
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 """Filter class to restrict stdout handler from posting messages handled by stderr handler"""
 class StdOutFilter(logging.Filter):
     def filter(self, record: logging.LogRecord):
         return record.levelno < logging.ERROR
 
 class LogSetup:
+    ROTATE_NONE = "none"
+    ROTATE_SIZE = "size"
+    ROTATE_TIME = "time"
+    ROTATE_MODES = (ROTATE_NONE, ROTATE_SIZE, ROTATE_TIME)
+
+    ROTATE_MAX_BYTES = 10 * 1024 * 1024
+    ROTATE_WHEN = "midnight"
+    ROTATE_BACKUPS = 14
+
+    __listener = None
+
     @staticmethod
-    def setup(level: int, stdout: bool, stderr: bool, file: bool, location: str):
+    def setup(level: int, stdout: bool, stderr: bool, file: bool, location: str, json_lines: bool = False,
+              rotate: str = ROTATE_NONE):
         # Basic setup
         logger = logging.getLogger()
         logging.addLevelName(logging.WARNING, "WARN")
         logger.setLevel(level)
 
-        log_formatter = CustMultiLineFormatter("%(asctime)s [%(threadName)-18.30s] [%(levelname)-5.5s] %(message)s")
-        log_formatter.default_msec_format = '%s.%03d'
+        if json_lines:
+            log_formatter = JsonLinesFormatter()
+        else:
+            log_formatter = CustMultiLineFormatter("%(asctime)s [%(threadName)-18.30s] [%(levelname)-5.5s] %(message)s")
+            log_formatter.default_msec_format = '%s.%03d'
+        handlers = []
 
         # Disable requests and urllib3 library (blacklist). If more issues come up then I'll have to refactor
         logging.getLogger("requests").setLevel(logging.INFO)
@@ -67,30 +122,67 @@ class LogSetup:
             stdout_handler.setFormatter(log_formatter)
             stdout_handler.setLevel(logging.DEBUG)
             stdout_handler.addFilter(StdOutFilter())
-            logger.addHandler(stdout_handler)
+            handlers.append(stdout_handler)
 
         # Standard error handler
         if stdout or stderr:
             stderr_handler = logging.StreamHandler(sys.stderr)
             stderr_handler.setFormatter(log_formatter)
             stderr_handler.setLevel(logging.ERROR)
-            logger.addHandler(stderr_handler)
+            handlers.append(stderr_handler)
 
         # File handler
         if file:
             if not os.path.isdir(location):
                 os.makedirs(location, exist_ok=True)
 
-            file_handler = logging.FileHandler(f"{location}/" + datetime.now().strftime("%Y-%m-%d %H;%M;%S") + ".txt")
+            file_handler = LogSetup.__file_handler(location, rotate)
             file_handler.setFormatter(log_formatter)
             file_handler.setLevel(logging.DEBUG)
-            logger.addHandler(file_handler)
+            handlers.append(file_handler)
+
+        # Handlers run on the listener's thread, so logging calls only ever queue the record
+        if handlers:
+            log_queue = SimpleQueue()
+            LogSetup.__listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+            LogSetup.__listener.start()
+            logger.addHandler(DeferredQueueHandler(log_queue))
+            atexit.register(LogSetup.stop)
 
         # Override default handling of uncaught exceptions (program crash)
         sys.excepthook = LogSetup.handle_top_exception
 
         logger.info("Logging initialised")
 
+    @staticmethod
+    def stop():
+        # Writes out anything still queued
+        if LogSetup.__listener is not None:
+            LogSetup.__listener.stop()
+            LogSetup.__listener = None
+
+    @staticmethod
+    def __file_handler(location: str, rotate: str):
+        if rotate == LogSetup.ROTATE_NONE:
+            return logging.FileHandler(f"{location}/" + datetime.now().strftime("%Y-%m-%d %H;%M;%S") + ".txt")
+
+        if rotate == LogSetup.ROTATE_SIZE:
+            handler = RotatingFileHandler(f"{location}/slack_tenor.txt", maxBytes=LogSetup.ROTATE_MAX_BYTES,
+                                          backupCount=LogSetup.ROTATE_BACKUPS)
+        else:
+            handler = TimedRotatingFileHandler(f"{location}/slack_tenor.txt", when=LogSetup.ROTATE_WHEN,
+                                               backupCount=LogSetup.ROTATE_BACKUPS)
+        # Rotated files are compressed
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = LogSetup.__compress
+        return handler
+
+    @staticmethod
+    def __compress(source: str, dest: str):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
     # noinspection PyUnusedLocal
     @staticmethod
     def handle_top_exception(exctype, value, traceback):
@@ -1,16 +1,21 @@
 import argparse
 import logging
 import os
-import uuid
-from datetime import datetime
-from sqlite3 import DatabaseError
-
-from slack_bolt import App
 
 from blockresults import BlockResults
+from circuitbreaker import CircuitBreaker
 from database import Database
+from handlers import create_app
 from image import Image
+from janitor import Janitor
 from logsetup import LogSetup
+from metrics import Metrics
+from migrations import Migrations
+from page_sizer import PageSizer
+from ratelimit import TokenBucket
+from session_store import SessionStore
+from share_queue import ShareQueue
+from tenor_cache import TenorCache
 from tenor_search import Tenor
 
 LOG_LOC = "log_slack_tenor"
@@ -31,113 +36,171 @@ parser.add_argument("--disable-stdout", "-dso", action="store_true",
                     help="Disable log messages lower than ERROR from appearing in stdout")
 parser.add_argument("--disable-stderr", "-dse", action="store_true",
                     help="Disable error messages from appearing in stdout (requires --disable-stdout to also be set)")
-args = parser.parse_args()
-
-
-# Initializes your app with your bot token and signing secret
-Tenor.TENOR_API_KEY = getattr(args, "tenor api key")
-LogSetup.setup(logging.INFO, not args.disable_stdout, not args.disable_stderr, args.log_file, LOG_LOC)
-
-app = App(
-    token=getattr(args, "slack bot token"),
-    signing_secret=getattr(args, "slack signing secret")
-)
-
-@app.error
-def error_handler(error, body, logger, respond):
-    logger.exception(f"Error: {error}")
-    logger.info(f"Request body: {body}")
-
-    if respond is not None:
-        respond("Encountered an error processing request. Please contact AgentKay for help", replace_original=False, response_type="ephemeral")
-
-@app.command(command="/tenor")
-def tenor_search(ack, respond, command):
-    conversation_id = command['channel_id']
-    conversation = command['channel_name']
-    user_id = command['user_id']
-    username = command['user_name']
-    query_str = command['text']
-
-    block_uid = str(uuid.uuid4())
-    logging.info(f"Received new request {block_uid} from user '{username}' ({user_id}) in channel '{conversation}' ({conversation_id}). Query: {query_str}")
-    ack()
-
-    with Database() as db:
-        cursor = db.execute("""INSERT INTO slack_request (timestamp, user_id, conversation_id, block_uid, search_string, status)
-            VALUES (?, ?, ?, ?, ?, ?)""", (
-            datetime.now().isoformat(),
-            user_id,
-            conversation_id,
-            block_uid,
-            query_str,
-            'SELECTING'
-        ))
-        if cursor.rowcount != 1:
-            raise DatabaseError(f"Error creating record. Rowcount: {cursor.rowcount}")
-
-    image = Tenor(block_uid).next_image()
-    results = BlockResults(block_uid, image, user_id, query_str)
-    respond(blocks=results.get_ephemeral_message(), response_type="ephemeral")
-
-@app.action("action_send")
-def send_message(ack, respond, action):
-    block_uid = action.get('block_id')
-    logging.info(f"Received send request for {block_uid}")
-    ack()
-
-    tenor = Tenor(block_uid)
-    request = tenor.fetch_request()
-
-    image = tenor.get_send_image_and_delete_others()
-    results = BlockResults(block_uid, image, request['user_id'], request['search_string'])
-    respond(blocks=results.get_command_post_message(), response_type="in_channel", delete_original=True)
-
-    with Database() as db:
-        cursor = db.execute("""
-            UPDATE slack_request
-            SET status = 'POSTED'
-            WHERE block_uid = ?""",
-            (block_uid, )
-        )
-        if cursor.rowcount == 1:
-            logging.info(f"Set message {block_uid} as posted")
-        else:
-            raise DatabaseError(f"Error updating status. Rowcount: {cursor.rowcount}")
-    tenor.register_image_as_shared(image)
-
-@app.action("action_next")
-def next_message(ack, respond, action):
-    block_uid = action.get('block_id')
-    logging.info(f"Received next request for {block_uid}")
-    ack()
-
-    tenor = Tenor(block_uid)
-    request = tenor.fetch_request()
-
-    image = tenor.next_image()
-    results = BlockResults(block_uid, image, request['user_id'], request['search_string'])
-    respond(blocks=results.get_ephemeral_message(), response_type="ephemeral")
-
-@app.action("action_cancel")
-def delete_message(ack, respond, action):
-    block_uid = action.get('block_id')
-    logging.info(f"Received cancel request for {block_uid}")
-    ack()
-    respond(delete_original=True)
+parser.add_argument("--log-json", action="store_true",
+                    help="Write logs as JSON lines rather than plain text")
+parser.add_argument("--log-rotate", default=LogSetup.ROTATE_NONE, choices=LogSetup.ROTATE_MODES,
+                    help="Write log files to one file, rotated (and compressed) by size or daily, rather than a new " +
+                         "file per run")
+parser.add_argument("--log-max-bytes", default=LogSetup.ROTATE_MAX_BYTES, type=int,
+                    help="Size at which the log file is rotated, with --log-rotate size")
+parser.add_argument("--log-backups", default=LogSetup.ROTATE_BACKUPS, type=int,
+                    help="Number of rotated log files to keep")
+parser.add_argument("--tenor-url", default=Tenor.TENOR_URL,
+                    help="Base URL of the tenor API (eg. the stub server in benchmark/)")
+parser.add_argument("--slack-api-url", default=None,
+                    help="Base URL of the slack web API, if not slack's own (eg. the stub server in benchmark/)")
+parser.add_argument("--tenor-pool-size", default=Tenor.HTTP_POOL_SIZE, type=int,
+                    help="Maximum number of keep-alive connections held open to tenor")
+parser.add_argument("--tenor-connect-timeout", default=Tenor.HTTP_CONNECT_TIMEOUT, type=float,
+                    help="Seconds to wait when connecting to tenor")
+parser.add_argument("--tenor-read-timeout", default=Tenor.HTTP_READ_TIMEOUT, type=float,
+                    help="Seconds to wait for tenor to respond once connected")
+parser.add_argument("--tenor-retries", default=Tenor.HTTP_RETRIES, type=int,
+                    help="Number of times to retry tenor requests that fail with a 429/5xx or a connection error")
+parser.add_argument("--tenor-retry-backoff", default=Tenor.HTTP_RETRY_BACKOFF, type=float,
+                    help="Backoff factor (seconds) between tenor retries, doubling after each attempt")
+parser.add_argument("--tenor-cache-size", default=256, type=int,
+                    help="Maximum number of tenor result pages to cache in memory (0 to disable)")
+parser.add_argument("--tenor-cache-ttl", default=300, type=float,
+                    help="Seconds a cached tenor result page is served for")
+parser.add_argument("--tenor-cache-variety", default=TenorCache.VARIETY_SHUFFLE, choices=TenorCache.VARIETY_MODES,
+                    help="How cached results are reordered so repeat searches still vary")
+parser.add_argument("--page-size", default=Tenor.LIMIT, type=int,
+                    help="Number of results to fetch from tenor at a time, until there's enough history to pick sizes")
+parser.add_argument("--page-size-min", default=PageSizer.MIN_LIMIT, type=int,
+                    help="Smallest page size to pick from past searches (at least --grid-size)")
+parser.add_argument("--page-size-max", default=PageSizer.MAX_LIMIT, type=int,
+                    help="Largest page size to pick from past searches")
+parser.add_argument("--page-size-history", default=PageSizer.HISTORY, type=int,
+                    help="Number of past searches used to pick page sizes (0 to disable, always using --page-size)")
+parser.add_argument("--overfetch-pages", default=Tenor.OVERFETCH_PAGES, type=int,
+                    help="Extra tenor pages to fetch straight away when results the search already had leave less " +
+                         "than a page of new ones (0 to disable)")
+parser.add_argument("--prefetch-low-water", default=Tenor.PREFETCH_LOW_WATER, type=int,
+                    help="Fetch the next tenor page in the background once fewer than this many results are left "
+                         "unseen for a request (0 to disable)")
+parser.add_argument("--share-workers", default=ShareQueue.WORKERS, type=int,
+                    help="Number of share registrations sent to tenor concurrently")
+parser.add_argument("--share-max-age", default=ShareQueue.MAX_AGE, type=int,
+                    help="Seconds to keep retrying a share registration with tenor for before giving up")
+parser.add_argument("--store-raw-gif-objects", action="store_true",
+                    help="Also store the full tenor object for each result (compressed), not just the fields used")
+parser.add_argument("--max-image-size", default=Image.MAX_IMAGE_SIZE, type=int,
+                    help="Largest gif rendition (bytes) to post. The smallest rendition is used if none fit")
+parser.add_argument("--small-image-size", default=Image.SMALL_IMAGE_SIZE, type=int,
+                    help="Largest gif rendition (bytes) to use for small previews")
+parser.add_argument("--small-previews", action="store_true",
+                    help="Use the small rendition when previewing gifs to the user, and the full one when posting")
+parser.add_argument("--grid-size", default=BlockResults.GRID_SIZE, type=int,
+                    help=f"Number of gifs to preview at once, each with their own send button (up to " +
+                         f"{BlockResults.MAX_GRID_SIZE})")
+parser.add_argument("--session-ttl", default=Janitor.IDLE_TTL, type=int,
+                    help="Seconds after which a search that was never sent or cancelled is expired")
+parser.add_argument("--janitor-interval", default=Janitor.INTERVAL, type=int,
+                    help="Seconds between runs of the janitor that expires searches and removes unused results " +
+                         "(0 to disable, eg. when running janitor.py separately)")
+parser.add_argument("--session-cache-size", default=SessionStore.MAX_SESSIONS, type=int,
+                    help="Maximum searches held in memory, so button clicks don't need to read the database " +
+                         "(0 to always use the database, which is forced for a libSQL --database)")
+parser.add_argument("--session-cache-ttl", default=SessionStore.TTL, type=int,
+                    help="Seconds a search is held in memory after its last click")
+parser.add_argument("--async", dest="use_async", action="store_true",
+                    help="Serve requests with an asyncio app, rather than a thread per request")
+parser.add_argument("--async-workers", default=16, type=int,
+                    help="Threads available to the asyncio app for database work (tenor and slack are awaited on " +
+                         "the event loop)")
+parser.add_argument("--tenor-rate", default=Tenor.LIMITER.rate, type=float,
+                    help="Maximum tenor requests per second, shared by searches and share registrations (0 for no limit)")
+parser.add_argument("--tenor-burst", default=Tenor.LIMITER.burst, type=int,
+                    help="Number of tenor requests that can be made at once before --tenor-rate applies")
+parser.add_argument("--tenor-max-wait", default=Tenor.LIMITER.max_wait, type=float,
+                    help="Seconds a request will queue for the tenor rate limit before failing")
+parser.add_argument("--tenor-background-headroom", default=Tenor.BACKGROUND_HEADROOM, type=float,
+                    help="Fraction of --tenor-burst that prefetches and share registrations leave for searches, " +
+                         "which they never queue for")
+parser.add_argument("--tenor-breaker-failures", default=Tenor.BREAKER.failure_threshold, type=int,
+                    help="Consecutive failed tenor requests after which tenor isn't called for a while, and previously " +
+                         "fetched results are used instead (0 to disable)")
+parser.add_argument("--tenor-breaker-reset", default=Tenor.BREAKER.reset_timeout, type=float,
+                    help="Seconds to wait before trying tenor again once it has been failing")
+parser.add_argument("--tenor-breaker-probes", default=Tenor.BREAKER.half_open_calls, type=int,
+                    help="Number of trial requests that must succeed before tenor is used normally again")
+parser.add_argument("--metrics-port", default=0, type=int,
+                    help="Port to serve prometheus metrics on at /metrics (0 to disable, which skips collecting them)")
+parser.add_argument("--database", default=str(Database.BACKEND),
+                    help="SQLite file to store searches in, or the URL of a libSQL server (eg. http://localhost:8080) " +
+                         "to share one database between several workers or nodes")
+parser.add_argument("--database-auth-token", default=None,
+                    help="Token to authenticate with the libSQL server, if --database is one")
+
+
+def configure(args):
+    # Shared by running main.py directly, and the WSGI/ASGI entry point for multi-worker servers (wsgi.py)
+    # Initializes your app with your bot token and signing secret
+    Tenor.TENOR_API_KEY = getattr(args, "tenor api key")
+    Tenor.set_url(args.tenor_url)
+    Tenor.HTTP_POOL_SIZE = args.tenor_pool_size
+    Tenor.HTTP_CONNECT_TIMEOUT = args.tenor_connect_timeout
+    Tenor.HTTP_READ_TIMEOUT = args.tenor_read_timeout
+    Tenor.HTTP_RETRIES = args.tenor_retries
+    Tenor.HTTP_RETRY_BACKOFF = args.tenor_retry_backoff
+    Tenor.PREFETCH_LOW_WATER = args.prefetch_low_water
+    Tenor.OVERFETCH_PAGES = args.overfetch_pages
+    Tenor.STORE_RAW_OBJECT = args.store_raw_gif_objects
+    Image.MAX_IMAGE_SIZE = args.max_image_size
+    Image.SMALL_IMAGE_SIZE = args.small_image_size
+    BlockResults.SMALL_PREVIEWS = args.small_previews
+    BlockResults.GRID_SIZE = max(1, min(args.grid_size, BlockResults.MAX_GRID_SIZE))
+    Tenor.LIMIT = max(args.page_size, BlockResults.GRID_SIZE)
+    PageSizer.MIN_LIMIT = max(args.page_size_min, BlockResults.GRID_SIZE)
+    PageSizer.MAX_LIMIT = max(args.page_size_max, PageSizer.MIN_LIMIT)
+    PageSizer.HISTORY = args.page_size_history
+    Tenor.CACHE = TenorCache(args.tenor_cache_size, args.tenor_cache_ttl, args.tenor_cache_variety)
+    Tenor.LIMITER = TokenBucket(args.tenor_rate, args.tenor_burst, args.tenor_max_wait)
+    Tenor.BACKGROUND_HEADROOM = args.tenor_background_headroom
+    Tenor.BREAKER = CircuitBreaker("tenor", args.tenor_breaker_failures, args.tenor_breaker_reset, args.tenor_breaker_probes)
+    ShareQueue.WORKERS = args.share_workers
+    ShareQueue.MAX_AGE = args.share_max_age
+    SessionStore.MAX_SESSIONS = args.session_cache_size
+    SessionStore.TTL = args.session_cache_ttl
+    Janitor.IDLE_TTL = args.session_ttl
+    Janitor.INTERVAL = args.janitor_interval
+    Metrics.ENABLED = args.metrics_port > 0
+    LogSetup.ROTATE_MAX_BYTES = args.log_max_bytes
+    LogSetup.ROTATE_BACKUPS = args.log_backups
+    LogSetup.setup(logging.INFO, not args.disable_stdout, not args.disable_stderr, args.log_file, LOG_LOC,
+                   args.log_json, args.log_rotate)
+    Database.configure(args.database, args.database_auth_token)
+    if Database.BACKEND.SHARED and SessionStore.enabled():
+        # Other nodes may handle a search's clicks, so an in memory copy of it would go stale
+        logging.info("Not holding searches in memory, as the database is shared with other nodes")
+        SessionStore.MAX_SESSIONS = 0
+
+    if args.use_async:
+        # Imported here, as the async app needs aiohttp which the threaded one doesn't
+        from async_app import create_async_app
+        app = create_async_app(getattr(args, "slack bot token"), getattr(args, "slack signing secret"),
+                               args.async_workers, args.slack_api_url)
+    else:
+        app = create_app(getattr(args, "slack bot token"), getattr(args, "slack signing secret"), args.slack_api_url)
+    return app
+
+
+def start_background_jobs(args):
+    Migrations.migrate()
+    ShareQueue.start(Tenor.register_share)
+    if SessionStore.enabled():
+        SessionStore.start()
+    if Janitor.INTERVAL > 0:
+        Janitor.start()
+    if Metrics.ENABLED:
+        Metrics.add_collector(Tenor.collect_metrics)
+        Metrics.start_server(args.metrics_port)
 
-    with Database() as db:
-        cursor = db.execute("""
-            UPDATE slack_request
-            SET status = 'CANCELLED'
-            WHERE block_uid = ?""",
-            (block_uid, )
-        )
-        if cursor.rowcount == 1:
-            logging.info(f"Deleted message {block_uid}")
-        else:
-            raise DatabaseError(f"Error updating status. Rowcount: {cursor.rowcount}")
 
 # Start your app
 if __name__ == "__main__":
+    args = parser.parse_args()
+    app = configure(args)
+    start_background_jobs(args)
     app.start(port=args.port, path="/tenor")
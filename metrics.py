@@ -0,0 +1,198 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""Process wide counters and latency histograms, served in the Prometheus text format by start_server
+Everything is a no-op until ENABLED is set, so instrumented code only pays for an attribute check"""
+class Metrics:
+    ENABLED = False
+    PREFIX = "slack_tenor_"
+
+    __metrics = []
+    __collectors = []
+    __server = None
+
+    @staticmethod
+    def register(metric):
+        Metrics.__metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def add_collector(collector):
+        # Called on each scrape, returning (name, type, help, value) for values kept elsewhere (eg. cache stats)
+        Metrics.__collectors.append(collector)
+
+    @staticmethod
+    def timed(histogram, *label_values):
+        def decorate(fn):
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with histogram.time(*label_values):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not Metrics.ENABLED:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, *label_values)
+            return wrapper
+        return decorate
+
+    @staticmethod
+    def render():
+        lines = []
+        for metric in Metrics.__metrics:
+            metric.render(lines)
+        for collector in Metrics.__collectors:
+            for name, kind, help_text, value in collector():
+                lines.append(f"# HELP {Metrics.PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {Metrics.PREFIX}{name} {kind}")
+                lines.append(f"{Metrics.PREFIX}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def start_server(port: int, host: str = ""):
+        if Metrics.__server is not None:
+            return
+
+        Metrics.__server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        Metrics.__server.daemon_threads = True
+        threading.Thread(target=Metrics.__server.serve_forever, name="MetricsServer", daemon=True).start()
+        logging.info("Serving metrics on port %s at /metrics", port)
+
+    @staticmethod
+    def stop_server():
+        if Metrics.__server is not None:
+            Metrics.__server.shutdown()
+            Metrics.__server.server_close()
+            Metrics.__server = None
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = Metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be printed to stderr every few seconds
+        pass
+
+"""Base for metrics with optional labels, where each combination of label values is tracked separately"""
+class _Metric:
+    KIND = None
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = Metrics.PREFIX + name
+        self.help_text = help_text
+        self.labels = labels
+
+        self._values = {}
+        self._lock = threading.Lock()
+        Metrics.register(self)
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} {self.KIND}")
+        with self._lock:
+            # Copied, as they're formatted outside the lock
+            values = sorted((label_values, self._copy(value)) for label_values, value in self._values.items())
+        for label_values, value in values:
+            self._render_value(lines, self.__format_labels(label_values), value)
+
+    def _copy(self, value):
+        return value
+
+    def _render_value(self, lines: list, labels: str, value):
+        lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+
+    def __format_labels(self, label_values: tuple):
+        return ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+
+class Counter(_Metric):
+    KIND = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        if not Metrics.ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Histogram(_Metric):
+    KIND = "histogram"
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        if not Metrics.ENABLED:
+            return
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum of observed values
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values) if Metrics.ENABLED else _NO_TIMER
+
+    def _copy(self, counts: list):
+        return list(counts)
+
+    def _render_value(self, lines: list, labels: str, counts: list):
+        separator = "," if labels else ""
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {total}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        lines.append(f"{self.name}_count{labels} {total}")
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_TIMER = _NoTimer()
+
+# Shared between the handlers and the janitor, which finish searches
+SESSIONS = Counter("sessions_total", "Searches by the status they finished with", ("status",))
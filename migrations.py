@@ -0,0 +1,330 @@
+import json
+import logging
+import sqlite3
+from sqlite3 import Connection
+
+from database import Database
+from image import Image
+from posted_index import PostedIndex
+from queries import Queries
+
+"""In place schema migrations, tracked with PRAGMA user_version
+Each migration runs in its own transaction. Never edit a released migration, append a new one instead
+Steps are either SQL statements or functions taking the connection, for data that has to be migrated in python"""
+class Migrations:
+    MIGRATIONS = [
+        # 1: Initial schema (IF NOT EXISTS, so databases made by the old create-db.py are adopted as is)
+        [
+            # language=SQL
+            """
+            CREATE TABLE IF NOT EXISTS slack_request (
+                id              INTEGER     NOT NULL CONSTRAINT pk_slack_request PRIMARY KEY AUTOINCREMENT,
+                timestamp       TEXT        NOT NULL,
+                user_id         TEXT        NOT NULL,
+                conversation_id TEXT        NOT NULL,
+                block_uid       TEXT        NOT NULL,
+                search_string   TEXT        NOT NULL,
+                status          TEXT        NOT NULL,
+
+                CONSTRAINT uk_slack_request_block_uid UNIQUE (block_uid),
+                CONSTRAINT ck_slack_request_status CHECK (status IN ('SELECTING', 'CANCELLED', 'POSTED'))
+            )
+            """,
+            # language=SQL
+            """
+            CREATE TABLE IF NOT EXISTS tenor_result (
+                id                  INTEGER     NOT NULL CONSTRAINT pk_tenor_result PRIMARY KEY AUTOINCREMENT,
+                slack_request_id    INTEGER     NOT NULL,
+                position            INTEGER     NOT NULL,
+                gif_object          TEXT        NOT NULL,
+                status              TEXT        NOT NULL,
+                next_pos            TEXT        NULL,
+
+                CONSTRAINT uk_tenor_result_slack_request_order UNIQUE (slack_request_id, position),
+                CONSTRAINT fk_tenor_result_slack_request FOREIGN KEY (slack_request_id) REFERENCES slack_request (id),
+                CONSTRAINT ck_tenor_result_status CHECK (status IN ('FETCHED', 'SELECTING', 'USED'))
+            )
+            """,
+            # language=SQL
+            """
+            CREATE TABLE IF NOT EXISTS share_registration (
+                id                  INTEGER     NOT NULL CONSTRAINT pk_share_registration PRIMARY KEY AUTOINCREMENT,
+                slack_request_id    INTEGER     NOT NULL,
+                tenor_id            TEXT        NOT NULL,
+                search_string       TEXT        NOT NULL,
+                status              TEXT        NOT NULL,
+                attempts            INTEGER     NOT NULL,
+                next_attempt        TEXT        NOT NULL,
+
+                CONSTRAINT fk_share_registration_slack_request FOREIGN KEY (slack_request_id) REFERENCES slack_request (id),
+                CONSTRAINT ck_share_registration_status CHECK (status IN ('PENDING', 'FAILED'))
+            )
+            """
+        ],
+        # 2: Indexes for the handler, share queue and cleanup/reporting queries
+        [
+            # language=SQL
+            """
+            CREATE INDEX ix_tenor_result_request_status_position
+            ON tenor_result (slack_request_id, status, position)
+            """,
+            # language=SQL
+            """
+            CREATE INDEX ix_slack_request_status_timestamp
+            ON slack_request (status, timestamp)
+            """,
+            # language=SQL
+            """
+            CREATE INDEX ix_share_registration_status_next_attempt
+            ON share_registration (status, next_attempt)
+            """
+        ],
+        # 3: Store the fields used from each tenor object in columns, rather than the whole JSON object
+        [
+            # language=SQL
+            """
+            CREATE TABLE tenor_result_new (
+                id                  INTEGER     NOT NULL CONSTRAINT pk_tenor_result PRIMARY KEY AUTOINCREMENT,
+                slack_request_id    INTEGER     NOT NULL,
+                position            INTEGER     NOT NULL,
+                tenor_id            TEXT        NOT NULL,
+                description         TEXT        NOT NULL,
+                gif_url             TEXT        NOT NULL,
+                gif_size            INTEGER     NOT NULL,
+                raw_object          BLOB        NULL,
+                status              TEXT        NOT NULL,
+                next_pos            TEXT        NULL,
+
+                CONSTRAINT uk_tenor_result_slack_request_order UNIQUE (slack_request_id, position),
+                CONSTRAINT fk_tenor_result_slack_request FOREIGN KEY (slack_request_id) REFERENCES slack_request (id),
+                CONSTRAINT ck_tenor_result_status CHECK (status IN ('FETCHED', 'SELECTING', 'USED'))
+            )
+            """,
+            lambda db: Migrations.project_gif_objects(db),
+            # language=SQL
+            "DROP TABLE tenor_result",
+            # language=SQL
+            "ALTER TABLE tenor_result_new RENAME TO tenor_result",
+            # language=SQL
+            """
+            CREATE INDEX ix_tenor_result_request_status_position
+            ON tenor_result (slack_request_id, status, position)
+            """
+        ],
+        # 4: Secondary, smaller rendition (null for existing rows, which fall back to the main rendition)
+        [
+            # language=SQL
+            "ALTER TABLE tenor_result ADD COLUMN small_gif_url TEXT NULL",
+            # language=SQL
+            "ALTER TABLE tenor_result ADD COLUMN small_gif_size INTEGER NULL"
+        ],
+        # 5: Allow requests to be expired by the janitor
+        [
+            # language=SQL
+            """
+            CREATE TABLE slack_request_new (
+                id              INTEGER     NOT NULL CONSTRAINT pk_slack_request PRIMARY KEY AUTOINCREMENT,
+                timestamp       TEXT        NOT NULL,
+                user_id         TEXT        NOT NULL,
+                conversation_id TEXT        NOT NULL,
+                block_uid       TEXT        NOT NULL,
+                search_string   TEXT        NOT NULL,
+                status          TEXT        NOT NULL,
+
+                CONSTRAINT uk_slack_request_block_uid UNIQUE (block_uid),
+                CONSTRAINT ck_slack_request_status CHECK (status IN ('SELECTING', 'CANCELLED', 'POSTED', 'EXPIRED'))
+            )
+            """,
+            # language=SQL
+            """
+            INSERT INTO slack_request_new (id, timestamp, user_id, conversation_id, block_uid, search_string, status)
+            SELECT id, timestamp, user_id, conversation_id, block_uid, search_string, status FROM slack_request
+            """,
+            # language=SQL
+            "DROP TABLE slack_request",
+            # language=SQL
+            "ALTER TABLE slack_request_new RENAME TO slack_request",
+            # language=SQL
+            """
+            CREATE INDEX ix_slack_request_status_timestamp
+            ON slack_request (status, timestamp)
+            """
+        ],
+        # 6: Recent requests by query and by user, for picking page sizes
+        [
+            # language=SQL
+            """
+            CREATE INDEX ix_slack_request_search_string_id
+            ON slack_request (search_string COLLATE NOCASE, id)
+            """,
+            # language=SQL
+            """
+            CREATE INDEX ix_slack_request_user_id_id
+            ON slack_request (user_id, id)
+            """
+        ],
+        # 7: Index of posted gifs by conversation and by user, for !recent/!top searches
+        [
+            # language=SQL
+            """
+            CREATE TABLE posted_gif (
+                id                  INTEGER     NOT NULL CONSTRAINT pk_posted_gif PRIMARY KEY AUTOINCREMENT,
+                scope               TEXT        NOT NULL,
+                scope_id            TEXT        NOT NULL,
+                tenor_id            TEXT        NOT NULL,
+                search_string       TEXT        NOT NULL,
+                description         TEXT        NOT NULL,
+                gif_url             TEXT        NOT NULL,
+                gif_size            INTEGER     NOT NULL,
+                small_gif_url       TEXT        NULL,
+                small_gif_size      INTEGER     NULL,
+                post_count          INTEGER     NOT NULL,
+                last_posted         TEXT        NOT NULL,
+
+                CONSTRAINT uk_posted_gif_scope_tenor_id UNIQUE (scope, scope_id, tenor_id),
+                CONSTRAINT ck_posted_gif_scope CHECK (scope IN ('conversation', 'user'))
+            )
+            """,
+            # language=SQL
+            """
+            CREATE INDEX ix_posted_gif_scope_last_posted
+            ON posted_gif (scope, scope_id, last_posted)
+            """,
+            # language=SQL
+            """
+            CREATE INDEX ix_posted_gif_scope_post_count
+            ON posted_gif (scope, scope_id, post_count)
+            """,
+            lambda db: PostedIndex.backfill(db)
+        ],
+        # 8: Time of each request's last click, so the janitor only expires idle requests
+        [
+            # language=SQL
+            "ALTER TABLE slack_request ADD COLUMN last_active TEXT NULL",
+            # language=SQL
+            "UPDATE slack_request SET last_active = timestamp",
+            # language=SQL
+            """
+            CREATE INDEX ix_slack_request_status_last_active
+            ON slack_request (status, last_active)
+            """
+        ],
+        # 9: When each share registration was queued, so the share queue gives up on age rather than attempts
+        [
+            # language=SQL
+            "ALTER TABLE share_registration ADD COLUMN queued_at TEXT NULL",
+            # language=SQL
+            """
+            UPDATE share_registration
+            SET queued_at = (SELECT timestamp FROM slack_request WHERE slack_request.id = slack_request_id)
+            """
+        ]
+    ]
+
+    # Plan steps that are expected not to use an index, by query name (a step matches if it starts with one of these)
+    EXPECTED_PLAN_STEPS = {
+        # Reads back from the newest request until there are enough finished ones, rather than sorting them all
+        "page size samples by all": ("SCAN sr",),
+        # Queries are matched by substring, so every request is scanned (from the smaller index on search_string)
+        "previous results": ("SCAN sr USING COVERING INDEX", "USE TEMP B-TREE FOR GROUP BY",
+                             "USE TEMP B-TREE FOR ORDER BY"),
+    }
+
+    @staticmethod
+    def migrate():
+        with Database() as db:
+            version = Migrations.get_version(db)
+            target = len(Migrations.MIGRATIONS)
+            if version > target:
+                raise RuntimeError(f"Database is at version {version}, which is newer than this code ({target})")
+            if version == target:
+                logging.info("Database schema is up to date (version %s)", version)
+                return
+
+            for number, statements in enumerate(Migrations.MIGRATIONS[version:], start=version + 1):
+                db.execute("BEGIN IMMEDIATE")
+                # Checked again under the write lock, as other workers may be migrating the same database
+                if Migrations.get_version(db) >= number:
+                    db.rollback()
+                    continue
+
+                logging.info("Applying database migration %s", number)
+                try:
+                    for statement in statements:
+                        if callable(statement):
+                            statement(db)
+                        else:
+                            db.execute(statement)
+                    db.execute(f"PRAGMA user_version = {number}")
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+
+            db.execute("ANALYZE")
+            db.commit()
+            logging.info("Migrated database schema from version %s to %s", version, target)
+
+    @staticmethod
+    def project_gif_objects(db: Connection):
+        # Raw objects aren't kept for existing rows, as the old ones were never compressed
+        skipped = 0
+        rows = db.execute("SELECT * FROM tenor_result ORDER BY id").fetchall()
+        for row in rows:
+            try:
+                image = Image.from_tenor(json.loads(row['gif_object']))
+            except (KeyError, IndexError, ValueError):
+                # Could never have been displayed (eg. no gif rendition small enough), so isn't worth keeping
+                skipped += 1
+                continue
+
+            # language=SQL
+            db.execute("""
+                INSERT INTO tenor_result_new (id, slack_request_id, position, tenor_id, description, gif_url, gif_size,
+                                              status, next_pos)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (row['id'], row['slack_request_id'], row['position'], image.id, image.description, image.url,
+                      image.size, row['status'], row['next_pos']))
+
+        logging.info("Projected %s stored gif objects into columns, skipped %s", len(rows) - skipped, skipped)
+
+    @staticmethod
+    def get_version(db: Connection):
+        return db.execute("PRAGMA user_version").fetchone()[0]
+
+    @staticmethod
+    def check_query_plans():
+        # Returns (query name, plan step) for every step of the code's queries that doesn't use an index
+        # Plans are checked against a copy of the schema without sqlite_stat1, so they're the ones SQLite picks before
+        # ANALYZE has run, and a small database doesn't make a full scan look cheaper than it will be
+        with Database() as db:
+            # language=SQL
+            schema = db.execute("""
+                SELECT sql FROM sqlite_master
+                WHERE sql IS NOT NULL
+                AND name NOT LIKE 'sqlite_%'
+                ORDER BY rowid
+                """).fetchall()
+
+        problems = []
+        copy = sqlite3.connect(":memory:")
+        copy.row_factory = sqlite3.Row
+        try:
+            for row in schema:
+                copy.execute(row['sql'])
+            for name, query in Queries.all().items():
+                params = (None,) * query.count("?")
+                for row in copy.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall():
+                    detail = row['detail']
+                    if Migrations.__is_unindexed(detail) and not detail.startswith(
+                            Migrations.EXPECTED_PLAN_STEPS.get(name, ())):
+                        problems.append((name, detail))
+        finally:
+            copy.close()
+        return problems
+
+    @staticmethod
+    def __is_unindexed(detail: str):
+        if detail.startswith("SCAN ") and "INDEX" not in detail:
+            return True
+        return "TEMP B-TREE" in detail
@@ -0,0 +1,23 @@
+import asyncio
+
+"""Runs the blocking parts of the async listeners and Tenor (database work, and anything that may load from it)
+In the async app they go to EXECUTOR, a bounded pool of threads, so the event loop is never waiting on SQLite. The
+threaded app leaves EXECUTOR unset, so they run inline, and uses run to drive the listeners on its own threads"""
+class Offload:
+    EXECUTOR = None
+
+    @staticmethod
+    def enabled():
+        return Offload.EXECUTOR is not None
+
+    @staticmethod
+    async def call(fn, *args):
+        if Offload.EXECUTOR is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(Offload.EXECUTOR, fn, *args)
+
+    @staticmethod
+    def run(coroutine):
+        # Runs a coroutine to completion on the calling thread, with a loop of its own that's closed afterwards (as
+        # the threaded app's worker threads come and go)
+        return asyncio.run(coroutine)
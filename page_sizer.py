@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from database import Database
+from queries import Queries
+
+"""Picks how many results to ask tenor for, from how many results past searches went through before being sent or
+abandoned. The same query's history is used if there's enough of it, then the same user's, then everyone's.
+The first and follow up page sizes are the pair, within bounds, that minimise the expected number of tenor calls
+plus UNUSED_RESULT_COST for each result stored but never shown. Choices are cached for CACHE_TTL seconds"""
+class PageSizer:
+    MIN_LIMIT = 2
+    MAX_LIMIT = 20
+    HISTORY = 50
+    MIN_SAMPLES = 5
+    UNUSED_RESULT_COST = 0.1
+    CACHE_TTL = 300
+    MAX_CACHED = 1000
+
+    __cache = OrderedDict()
+    __lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        return PageSizer.HISTORY > 0
+
+    @staticmethod
+    def page_sizes(search_string: str, user_id: str, default: int):
+        # Returns (first page size, follow up page size)
+        if not PageSizer.enabled():
+            return default, default
+
+        for key in (("query", search_string.lower()), ("user", user_id), ("all", None)):
+            sizes = PageSizer.__cached(key)
+            if sizes is None:
+                samples = PageSizer.__load_samples(*key)
+                sizes = PageSizer.choose(samples) if len(samples) >= PageSizer.MIN_SAMPLES else False
+                PageSizer.__store(key, sizes)
+            if sizes:
+                return sizes
+        return default, default
+
+    @staticmethod
+    def choose(samples: list):
+        best, best_cost = None, None
+        for first in range(PageSizer.MIN_LIMIT, PageSizer.MAX_LIMIT + 1):
+            for follow_up in range(PageSizer.MIN_LIMIT, PageSizer.MAX_LIMIT + 1):
+                cost = sum(PageSizer.__cost(shown, first, follow_up) for shown in samples)
+                if best_cost is None or cost < best_cost:
+                    best, best_cost = (first, follow_up), cost
+        return best
+
+    @staticmethod
+    def clear():
+        with PageSizer.__lock:
+            PageSizer.__cache.clear()
+
+    @staticmethod
+    def __cost(shown: int, first: int, follow_up: int):
+        # A session that went through shown results needs this many pages, leaving the rest of the last one unused
+        pages = 1 + max(0, -(-(shown - first) // follow_up))
+        stored = first + (pages - 1) * follow_up
+        return pages + PageSizer.UNUSED_RESULT_COST * (stored - shown)
+
+    @staticmethod
+    def __cached(key: tuple):
+        with PageSizer.__lock:
+            entry = PageSizer.__cache.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            PageSizer.__cache.move_to_end(key)
+            return entry[1]
+
+    @staticmethod
+    def __store(key: tuple, sizes):
+        with PageSizer.__lock:
+            PageSizer.__cache[key] = (time.monotonic() + PageSizer.CACHE_TTL, sizes)
+            PageSizer.__cache.move_to_end(key)
+            while len(PageSizer.__cache) > PageSizer.MAX_CACHED:
+                PageSizer.__cache.popitem(last=False)
+
+    @staticmethod
+    def __load_samples(kind: str, value):
+        params = () if value is None else (value,)
+        with Database() as db:
+            rows = db.execute(Queries.page_size_samples(kind), params + (PageSizer.HISTORY,)).fetchall()
+
+        samples = [row['shown'] for row in rows if row['shown'] > 0]
+        logging.debug("Loaded %s page size samples for %s %s", len(samples), kind, value)
+        return samples
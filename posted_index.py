@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime
+from sqlite3 import Connection
+
+from queries import Queries
+
+"""Index of the gifs posted in each conversation and by each user, kept up to date as gifs are sent
+Searches starting with a modifier (eg. /tenor !top party) page through it instead of tenor:
+    !recent, !top       Most recently/often posted in this conversation
+    !myrecent, !mytop   Most recently/often posted by you, in any conversation
+Anything after the modifier filters by the original search or the gif's description"""
+class PostedIndex:
+    SCOPE_CONVERSATION = "conversation"
+    SCOPE_USER = "user"
+
+    ORDER_RECENT, ORDER_TOP = Queries.POSTED_GIF_ORDERS
+
+    MODIFIERS = {
+        "!recent": (SCOPE_CONVERSATION, ORDER_RECENT),
+        "!top": (SCOPE_CONVERSATION, ORDER_TOP),
+        "!myrecent": (SCOPE_USER, ORDER_RECENT),
+        "!mytop": (SCOPE_USER, ORDER_TOP),
+    }
+
+    @staticmethod
+    def parse(search_string: str):
+        # Returns (scope, order, filter) for modifier searches, otherwise None
+        modifier, _, terms = search_string.strip().partition(" ")
+        if modifier.lower() not in PostedIndex.MODIFIERS:
+            return None
+        scope, order = PostedIndex.MODIFIERS[modifier.lower()]
+        return scope, order, terms.strip()
+
+    @staticmethod
+    def record(db: Connection, request, image):
+        # One row per gif in each scope, so lookups are a single index range rather than aggregating over requests
+        now = datetime.now().isoformat()
+        scopes = PostedIndex.__scopes(request)
+        search_string = request['search_string']
+        if PostedIndex.parse(search_string) is not None:
+            # Found through the index, so its row in the other scope has the query it was originally posted under
+            original = db.execute(Queries.ORIGINAL_POSTED_QUERY,
+                                  scopes[0] + (image.id,) + scopes[1] + (image.id,)).fetchone()
+            search_string = "" if original is None else original['search_string']
+
+        db.executemany(Queries.RECORD_POSTED_GIF, [(scope, scope_id, image.id, search_string, image.description,
+                                                    image.url, image.size, image.small_url, image.small_size, now)
+                                                   for (scope, scope_id) in scopes])
+
+    @staticmethod
+    def lookup(db: Connection, request, scope: str, order: str, terms: str, offset: int, limit: int):
+        scope_id = dict(PostedIndex.__scopes(request))[scope]
+        escaped = terms.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+        rows = db.execute(Queries.posted_gifs(order), (scope, scope_id, pattern, pattern, limit, offset)).fetchall()
+        logging.debug("Found %s posted gifs for %s %s matching '%s'", len(rows), scope, scope_id, terms)
+        return rows
+
+    @staticmethod
+    def backfill(db: Connection):
+        # Which result was sent isn't stored, so the last one shown is taken (only a guess if it was from a grid)
+        for scope, column in (PostedIndex.SCOPE_CONVERSATION, "conversation_id"), (PostedIndex.SCOPE_USER, "user_id"):
+            # language=SQL
+            db.execute(f"""
+                INSERT INTO posted_gif (scope, scope_id, tenor_id, search_string, description, gif_url, gif_size,
+                                        small_gif_url, small_gif_size, post_count, last_posted)
+                SELECT ?, sr.{column}, tr.tenor_id, sr.search_string, tr.description, tr.gif_url, tr.gif_size,
+                       tr.small_gif_url, tr.small_gif_size, COUNT(*), MAX(sr.timestamp)
+                FROM slack_request sr
+                INNER JOIN tenor_result tr ON (tr.slack_request_id = sr.id)
+                WHERE sr.status = 'POSTED'
+                AND tr.position = (
+                    SELECT MAX(position) FROM tenor_result
+                    WHERE slack_request_id = sr.id
+                    AND status = 'USED'
+                )
+                GROUP BY sr.{column}, tr.tenor_id
+                """, (scope,))
+
+    @staticmethod
+    def __scopes(request):
+        return [(PostedIndex.SCOPE_CONVERSATION, request['conversation_id']),
+                (PostedIndex.SCOPE_USER, request['user_id'])]
@@ -0,0 +1,295 @@
+"""SQL run by the handlers and background jobs, kept in one place so Migrations.check_query_plans checks the exact
+statements the code runs. Statements that vary (eg. by sort order) are built by the static methods, one per variant"""
+class Queries:
+    # Requests
+
+    # language=SQL
+    CREATE_REQUEST = """
+        INSERT INTO slack_request (timestamp, user_id, conversation_id, block_uid, search_string, status, last_active)
+        VALUES (?, ?, ?, ?, ?, 'SELECTING', ?)
+        """
+
+    # language=SQL
+    FETCH_REQUEST = """
+        SELECT * FROM slack_request
+        WHERE block_uid = ?
+        """
+
+    # language=SQL
+    POST_REQUEST = """
+        UPDATE slack_request
+        SET status = 'POSTED'
+        WHERE block_uid = ?
+        AND status = 'SELECTING'
+        """
+
+    # language=SQL
+    CANCEL_REQUEST = """
+        UPDATE slack_request
+        SET status = 'CANCELLED'
+        WHERE block_uid = ?
+        AND status = 'SELECTING'
+        """
+
+    # language=SQL
+    RECORD_ACTIVITY = """
+        UPDATE slack_request
+        SET last_active = ?
+        WHERE id = ?
+        """
+
+    # Results
+
+    # RETURNING doesn't guarantee an order, so callers put rows back into position order (a limit of -1 is all rows)
+    # language=SQL
+    STATE_TRANSITION = """
+        UPDATE tenor_result
+        SET status = ?
+        WHERE id IN (
+            SELECT id FROM tenor_result
+            WHERE slack_request_id = ?
+            AND status = ?
+            ORDER BY position ASC
+            LIMIT ?
+        )
+        RETURNING *
+        """
+
+    # language=SQL
+    SET_RESULT_STATUS = """
+        UPDATE tenor_result
+        SET status = ?
+        WHERE id = ?
+        """
+
+    # language=SQL
+    COUNT_FETCHED = """
+        SELECT COUNT(*) FROM tenor_result
+        WHERE slack_request_id = ?
+        AND status = 'FETCHED'
+        """
+
+    # language=SQL
+    DELETE_UNUSED = """
+        DELETE FROM tenor_result
+        WHERE slack_request_id = ?
+        AND status = 'FETCHED'
+        """
+
+    # language=SQL
+    SESSION_RESULTS = """
+        SELECT * FROM tenor_result
+        WHERE slack_request_id = ?
+        AND status IN ('FETCHED', 'SELECTING')
+        ORDER BY position ASC
+        """
+
+    # language=SQL
+    LAST_NEXT_POSITION = """
+        SELECT next_pos FROM tenor_result
+        WHERE slack_request_id = ?
+        ORDER BY position DESC
+        LIMIT 1
+        """
+
+    # language=SQL
+    SEEN_TENOR_IDS = """
+        SELECT tenor_id FROM tenor_result
+        WHERE slack_request_id = ?
+        """
+
+    # language=SQL
+    MAX_POSITION = """
+        SELECT COALESCE(MAX(position), 0) FROM tenor_result
+        WHERE slack_request_id = ?
+        """
+
+    # language=SQL
+    STORE_RESULT = """
+        INSERT INTO tenor_result (slack_request_id, position, tenor_id, description, gif_url, gif_size,
+                                  small_gif_url, small_gif_size, raw_object, status, next_pos)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'FETCHED', ?)
+        """
+
+    # language=SQL
+    STORED_RESULT_IDS = """
+        SELECT id FROM tenor_result
+        WHERE slack_request_id = ?
+        AND position > ?
+        ORDER BY position ASC
+        """
+
+    # Requests are read first (CROSS JOIN fixes the order), as their queries are matched by substring so can't use an
+    # index, and there are far fewer of them than results
+    # language=SQL
+    PREVIOUS_RESULTS = """
+        SELECT tr.tenor_id, tr.description, tr.gif_url, tr.gif_size, tr.small_gif_url, tr.small_gif_size,
+               MAX(tr.id)
+        FROM slack_request sr
+        CROSS JOIN tenor_result tr ON (tr.slack_request_id = sr.id)
+        WHERE sr.search_string LIKE ? ESCAPE '\\'
+        AND sr.id != ?
+        AND tr.tenor_id NOT IN (SELECT tenor_id FROM tenor_result WHERE slack_request_id = ?)
+        GROUP BY tr.tenor_id
+        ORDER BY MAX(tr.id) DESC
+        LIMIT ?
+        """
+
+    # Page sizes
+
+    PAGE_SIZE_SAMPLE_KINDS = ("query", "user", "all")
+
+    @staticmethod
+    def page_size_samples(kind: str):
+        # Results still shown (USED/SELECTING) are kept once a search is finished, unlike unused (FETCHED) ones
+        # Across everyone, reading back from the newest request until there are enough finished ones is cheaper than
+        # sorting every finished request, so the status index is kept out of it (+)
+        where = {
+            "query": "sr.search_string = ? COLLATE NOCASE AND sr.status",
+            "user": "sr.user_id = ? AND sr.status",
+            "all": "+sr.status"
+        }[kind]
+        # language=SQL
+        return f"""
+            SELECT (
+                SELECT COUNT(*) FROM tenor_result tr
+                WHERE tr.slack_request_id = sr.id
+                AND tr.status IN ('USED', 'SELECTING')
+            ) AS shown
+            FROM slack_request sr
+            WHERE {where} IN ('POSTED', 'CANCELLED', 'EXPIRED')
+            ORDER BY sr.id DESC
+            LIMIT ?
+            """
+
+    # Posted index
+
+    # A gif keeps the first query it was posted under, so reposts don't change what it can be found by
+    # language=SQL
+    RECORD_POSTED_GIF = """
+        INSERT INTO posted_gif (scope, scope_id, tenor_id, search_string, description, gif_url, gif_size,
+                                small_gif_url, small_gif_size, post_count, last_posted)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT (scope, scope_id, tenor_id) DO UPDATE
+        SET post_count = post_count + 1, last_posted = excluded.last_posted
+        """
+
+    # language=SQL
+    ORIGINAL_POSTED_QUERY = """
+        SELECT search_string FROM posted_gif
+        WHERE (scope = ? AND scope_id = ? AND tenor_id = ?)
+        OR (scope = ? AND scope_id = ? AND tenor_id = ?)
+        LIMIT 1
+        """
+
+    POSTED_GIF_ORDERS = ("last_posted", "post_count")
+
+    @staticmethod
+    def posted_gifs(order: str):
+        # language=SQL
+        return f"""
+            SELECT tenor_id, description, gif_url, gif_size, small_gif_url, small_gif_size FROM posted_gif
+            WHERE scope = ?
+            AND scope_id = ?
+            AND (search_string LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\')
+            ORDER BY {order} DESC, id DESC
+            LIMIT ? OFFSET ?
+            """
+
+    # Share registrations
+
+    # language=SQL
+    QUEUE_SHARE = """
+        INSERT INTO share_registration (slack_request_id, tenor_id, search_string, status, attempts, next_attempt,
+                                        queued_at)
+        SELECT id, ?, search_string, 'PENDING', 0, ?, ?
+        FROM slack_request
+        WHERE block_uid = ?
+        """
+
+    # Due rows are claimed by pushing their next attempt back, so other worker processes skip them meanwhile
+    # language=SQL
+    CLAIM_SHARES = """
+        UPDATE share_registration
+        SET next_attempt = ?
+        WHERE id IN (
+            SELECT id FROM share_registration
+            WHERE status = 'PENDING'
+            AND next_attempt <= ?
+            ORDER BY next_attempt ASC
+            LIMIT ?
+        )
+        RETURNING id, tenor_id, search_string, attempts, queued_at
+        """
+
+    # language=SQL
+    DELETE_SHARE = """
+        DELETE FROM share_registration
+        WHERE id = ?
+        """
+
+    # language=SQL
+    DEFER_SHARE = """
+        UPDATE share_registration
+        SET next_attempt = ?
+        WHERE id = ?
+        """
+
+    # language=SQL
+    RECORD_SHARE_FAILURE = """
+        UPDATE share_registration
+        SET status = ?, attempts = ?, next_attempt = ?
+        WHERE id = ?
+        """
+
+    # Janitor
+
+    # language=SQL
+    EXPIRE_REQUESTS = """
+        UPDATE slack_request
+        SET status = 'EXPIRED'
+        WHERE id IN (
+            SELECT id FROM slack_request
+            WHERE status = 'SELECTING'
+            AND last_active < ?
+            LIMIT ?
+        )
+        RETURNING block_uid
+        """
+
+    # The image that was being shown was seen, so is recorded the same way as skipped ones
+    # language=SQL
+    RETIRE_EXPIRED_RESULTS = """
+        UPDATE tenor_result
+        SET status = 'USED'
+        WHERE id IN (
+            SELECT tr.id FROM slack_request sr
+            INNER JOIN tenor_result tr ON (tr.slack_request_id = sr.id)
+            WHERE sr.status = 'EXPIRED'
+            AND tr.status = 'SELECTING'
+            LIMIT ?
+        )
+        """
+
+    # language=SQL
+    DELETE_ABANDONED_RESULTS = """
+        DELETE FROM tenor_result
+        WHERE id IN (
+            SELECT tr.id FROM slack_request sr
+            INNER JOIN tenor_result tr ON (tr.slack_request_id = sr.id)
+            WHERE sr.status IN ('CANCELLED', 'EXPIRED', 'POSTED')
+            AND tr.status = 'FETCHED'
+            LIMIT ?
+        )
+        """
+
+    @staticmethod
+    def all():
+        # Every statement above, by name, including each variant of the ones that vary
+        queries = {name.lower().replace("_", " "): value for name, value in vars(Queries).items()
+                   if name.isupper() and isinstance(value, str)}
+        for kind in Queries.PAGE_SIZE_SAMPLE_KINDS:
+            queries[f"page size samples by {kind}"] = Queries.page_size_samples(kind)
+        for order in Queries.POSTED_GIF_ORDERS:
+            queries[f"posted gifs by {order}"] = Queries.posted_gifs(order)
+        return queries
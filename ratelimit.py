@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+class RateLimitedError(RuntimeError):
+    def __init__(self, message: str, retry_in: float):
+        super().__init__(message)
+        # Seconds until a token is expected to be free
+        self.retry_in = retry_in
+
+"""Token bucket limiting calls to rate per second, with bursts of up to burst calls
+Callers queue for up to max_wait seconds for a token, with at most max_waiters queued at once"""
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, max_wait: float, max_waiters: int = 50):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_waiters = max_waiters
+
+        self.granted = 0
+        self.rejected = 0
+
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__paused_until = 0
+        self.__waiters = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        # Queues on the calling thread
+        if self.rate <= 0:
+            return True
+
+        deadline = time.monotonic() + self.max_wait
+        if not self.__join_queue():
+            return False
+        try:
+            while True:
+                granted, wait = self.__take(deadline)
+                if granted or wait is None:
+                    return granted
+                time.sleep(wait)
+        finally:
+            self.__leave_queue()
+
+    async def acquire_async(self):
+        # Same as acquire, but queues on the event loop rather than blocking it
+        if self.rate <= 0:
+            return True
+
+        deadline = time.monotonic() + self.max_wait
+        if not self.__join_queue():
+            return False
+        try:
+            while True:
+                granted, wait = self.__take(deadline)
+                if granted or wait is None:
+                    return granted
+                await asyncio.sleep(wait)
+        finally:
+            self.__leave_queue()
+
+    def try_acquire(self, keep: float = 0):
+        # Never waits, and only takes a token if there'd still be keep left and no one is queued for one, so
+        # background work can't hold up callers of acquire. Refusals aren't counted as rejected
+        if self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.__lock:
+            self.__refill(now)
+            if self.__waiters > 0 or now < self.__paused_until or self.__tokens < 1 + keep:
+                return False
+            self.__tokens -= 1
+            self.granted += 1
+            return True
+
+    def retry_in(self, keep: float = 0):
+        # Seconds until a token is expected to be free (with keep left over), ignoring anyone already queued for one
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.__lock:
+            self.__refill(now)
+            return max(0.0, self.__paused_until - now, (1 + keep - self.__tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # Used when upstream tells us we're over quota, so queued callers wait rather than adding to it
+        with self.__lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+            self.__tokens = 0
+
+    def __join_queue(self):
+        with self.__lock:
+            if self.__waiters >= self.max_waiters:
+                self.rejected += 1
+                return False
+            self.__waiters += 1
+            return True
+
+    def __leave_queue(self):
+        with self.__lock:
+            self.__waiters -= 1
+
+    def __take(self, deadline: float):
+        # Returns (True, 0) if a token was taken, otherwise (False, seconds to wait), or (False, None) to give up
+        now = time.monotonic()
+        with self.__lock:
+            self.__refill(now)
+            if now >= self.__paused_until and self.__tokens >= 1:
+                self.__tokens -= 1
+                self.granted += 1
+                return True, 0
+
+            wait = max(self.__paused_until - now, (1 - self.__tokens) / self.rate)
+            if now + wait > deadline:
+                self.rejected += 1
+                return False, None
+            return False, wait
+
+    def __refill(self, now: float):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+"""Runs a coroutine once for all concurrent callers with the same key, sharing its result (or exception)
+Callers may be on different event loops (eg. the threaded app's, one per thread)"""
+class SingleFlight:
+    def __init__(self):
+        self.coalesced = 0
+
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    async def do(self, key, fn):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            waiter = asyncio.wrap_future(call)
+            await asyncio.wait((waiter,))
+            error = waiter.exception()
+            if error is None:
+                return waiter.result()
+            # Each caller raises a copy of its own, as raising the one exception on several threads would have them
+            # all writing to its traceback
+            raise SingleFlight.__copy(error) from error
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.__finish(key)
+            call.set_exception(e)
+            raise
+        self.__finish(key)
+        call.set_result(result)
+        return result
+
+    def __finish(self, key):
+        with self.__lock:
+            del self.__calls[key]
+
+    @staticmethod
+    def __copy(error: BaseException):
+        # Without calling __init__, as eg. RateLimitedError takes more arguments than it keeps in args
+        copied = error.__class__.__new__(error.__class__, *error.args)
+        copied.args = error.args
+        copied.__dict__.update(error.__dict__)
+        return copied
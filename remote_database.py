@@ -0,0 +1,212 @@
+import base64
+import logging
+import sqlite3
+
+import requests
+
+"""Networked backend, for running several worker processes or nodes against one database
+Speaks the HTTP protocol (Hrana over HTTP, v2 pipelines) of a libSQL server (sqld), which uses SQLite's dialect so
+every query is unchanged. benchmark/stubs.py has a stand in server for trying it out locally"""
+class RemoteBackend:
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 30
+    SHARED = True
+
+    def __init__(self, url: str, auth_token: str = None):
+        # libsql:// URLs are served over https
+        if url.startswith("libsql://"):
+            url = "https://" + url.removeprefix("libsql://")
+        self.url = url.rstrip("/")
+        self.auth_token = auth_token
+
+    def __str__(self):
+        return self.url
+
+    def connect(self):
+        return RemoteConnection(self.url, self.auth_token)
+
+"""Result row, indexable by position or column name like sqlite3.Row"""
+class RemoteRow:
+    __slots__ = ("__columns", "__values")
+
+    def __init__(self, columns: dict, values: tuple):
+        self.__columns = columns
+        self.__values = values
+
+    def keys(self):
+        return list(self.__columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.__values[self.__columns[key]]
+        return self.__values[key]
+
+    def __iter__(self):
+        return iter(self.__values)
+
+    def __len__(self):
+        return len(self.__values)
+
+"""Result of a statement. Rows are all sent back at once, so this only supports what the app uses"""
+class RemoteCursor:
+    def __init__(self, rows: list, rowcount: int, lastrowid):
+        self.__rows = rows
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    def fetchone(self):
+        return self.__rows.pop(0) if self.__rows else None
+
+    def fetchall(self):
+        rows, self.__rows = self.__rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+"""Stands in for sqlite3.Connection, with the same transaction handling as the SQLite backend's connections:
+INSERT/UPDATE/DELETE begin an IMMEDIATE transaction if one isn't open, which lasts until commit or rollback
+Outside a transaction each statement is a single round trip on a new stream. Within one, the stream (and so the
+server side connection) is held onto with the baton the server hands back"""
+class RemoteConnection:
+    __BEGIN_IMPLICITLY = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def __init__(self, url: str, auth_token: str = None):
+        self.__url = url
+        self.__http = requests.Session()
+        if auth_token is not None:
+            self.__http.headers["Authorization"] = f"Bearer {auth_token}"
+
+        self.__baton = None
+        self.__base_url = None
+        self.in_transaction = False
+
+    def execute(self, sql: str, parameters=()):
+        return self.executemany(sql, [parameters])
+
+    def executemany(self, sql: str, seq_of_parameters):
+        # Every set of parameters is sent in one pipeline, rather than a round trip each
+        statements = [RemoteConnection.__statement(sql, parameters) for parameters in seq_of_parameters]
+        keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+
+        implicit_begin = not self.in_transaction and keyword in RemoteConnection.__BEGIN_IMPLICITLY
+        if implicit_begin:
+            statements.insert(0, RemoteConnection.__statement("BEGIN IMMEDIATE"))
+        if implicit_begin or keyword == "BEGIN":
+            # Set first, so a failed statement still leaves the transaction to be rolled back
+            self.in_transaction = True
+
+        results = self.__pipeline(statements, keep_stream=self.in_transaction)
+        if implicit_begin:
+            results = results[1:]
+
+        rows, rowcount, lastrowid = [], 0, None
+        for result in results:
+            columns = {column["name"]: i for i, column in enumerate(result["cols"])}
+            rows += [RemoteRow(columns, tuple(RemoteConnection.__decode(value) for value in row))
+                     for row in result["rows"]]
+            rowcount += result["affected_row_count"]
+            if result.get("last_insert_rowid") is not None:
+                lastrowid = int(result["last_insert_rowid"])
+        # Like sqlite3, only statements that change rows have a row count
+        if keyword not in RemoteConnection.__BEGIN_IMPLICITLY:
+            rowcount = -1
+        return RemoteCursor(rows, rowcount, lastrowid)
+
+    def commit(self):
+        self.__end("COMMIT")
+
+    def rollback(self):
+        try:
+            self.__end("ROLLBACK")
+        except sqlite3.DatabaseError:
+            # Eg. the server dropped the stream, which rolls it back anyway
+            logging.warning("Could not roll back remote transaction, discarding it", exc_info=True)
+
+    def close(self):
+        self.rollback()
+        self.__http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __end(self, statement: str):
+        if not self.in_transaction:
+            return
+        try:
+            self.__pipeline([RemoteConnection.__statement(statement)], keep_stream=False)
+        finally:
+            self.in_transaction = False
+
+    def __pipeline(self, statements: list, keep_stream: bool):
+        requests_ = [{"type": "execute", "stmt": statement} for statement in statements]
+        if not keep_stream:
+            requests_.append({"type": "close"})
+
+        try:
+            resp = self.__http.post(f"{self.__base_url or self.__url}/v2/pipeline",
+                                    json={"baton": self.__baton, "requests": requests_},
+                                    timeout=(RemoteBackend.CONNECT_TIMEOUT, RemoteBackend.READ_TIMEOUT))
+        except requests.RequestException as e:
+            self.__drop_stream()
+            raise sqlite3.OperationalError(f"Could not reach database server: {e}") from e
+        if not resp.ok:
+            # Eg. the baton expired, in which case the server has already rolled back
+            self.__drop_stream()
+            raise sqlite3.OperationalError(f"Database server returned {resp.status_code}: {resp.text[:200]}")
+
+        content = resp.json()
+        self.__baton = content.get("baton") if keep_stream else None
+        self.__base_url = content.get("base_url") if keep_stream else None
+
+        results = []
+        for result in content["results"][:len(statements)]:
+            if result["type"] == "error":
+                error = result["error"]
+                if "CONSTRAINT" in (error.get("code") or ""):
+                    raise sqlite3.IntegrityError(error["message"])
+                raise sqlite3.OperationalError(error["message"])
+            results.append(result["response"]["result"])
+        return results
+
+    def __drop_stream(self):
+        self.__baton = None
+        self.__base_url = None
+        self.in_transaction = False
+
+    @staticmethod
+    def __statement(sql: str, parameters=()):
+        return {"sql": sql, "args": [RemoteConnection.__encode(value) for value in parameters], "want_rows": True}
+
+    @staticmethod
+    def __encode(value):
+        if value is None:
+            return {"type": "null"}
+        # bool before int, as it's a subclass. Stored as 0/1 like sqlite3 does
+        if isinstance(value, (bool, int)):
+            return {"type": "integer", "value": str(int(value))}
+        if isinstance(value, float):
+            return {"type": "float", "value": value}
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return {"type": "blob", "base64": base64.b64encode(bytes(value)).decode()}
+        return {"type": "text", "value": str(value)}
+
+    @staticmethod
+    def __decode(value: dict):
+        kind = value["type"]
+        if kind == "null":
+            return None
+        if kind == "integer":
+            return int(value["value"])
+        if kind == "float":
+            return float(value["value"])
+        if kind == "blob":
+            return base64.b64decode(value["base64"])
+        return value["value"]
@@ -0,0 +1,258 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from sqlite3 import Connection, DatabaseError
+
+from database import Database
+from image import Image
+from queries import Queries
+
+"""State of a single request being selected, held in memory by the SessionStore
+Results are (tenor_result id, Image) pairs, in position order. seen holds the tenor id of every result ever stored
+for the request, so repeats from tenor can be dropped before they're stored"""
+class Session:
+    __slots__ = ("request", "queue", "current", "has_results", "tail_next_pos", "seen", "last_used", "lock")
+
+    def __init__(self, request: dict, queue: deque, current: list, has_results: bool, tail_next_pos, seen: set):
+        self.request = request
+        self.queue = queue
+        self.current = current
+        self.has_results = has_results
+        self.tail_next_pos = tail_next_pos
+        self.seen = seen
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def advance(self, count: int = 1, retire: bool = True):
+        # Same transitions as on disk: the shown results become USED, and the next FETCHED ones SELECTING
+        with self.lock:
+            if retire:
+                for result_id, _ in self.current:
+                    SessionStore.queue_status(result_id, 'USED')
+                self.current = []
+
+            selected = []
+            while self.queue and len(selected) < count:
+                result = self.queue.popleft()
+                SessionStore.queue_status(result[0], 'SELECTING')
+                selected.append(result)
+            self.current.extend(selected)
+            return selected, len(self.queue)
+
+    def take_current(self, result_id: int = None):
+        # Used when sending, so the remaining results are dropped. Without an id the first shown result is sent
+        with self.lock:
+            chosen = next((result for result in self.current if result_id is None or result[0] == result_id), None)
+            if chosen is None:
+                return None
+
+            for shown_id, _ in self.current:
+                SessionStore.queue_status(shown_id, 'USED')
+            self.current = []
+            self.queue.clear()
+            SessionStore.queue_delete_fetched(self.request['id'])
+            return chosen[1]
+
+    def extend(self, results: list, next_pos):
+        with self.lock:
+            # The session may have been reloaded from the database after these were stored
+            known = {result_id for (result_id, _) in self.queue}
+            known.update(result_id for (result_id, _) in self.current)
+            self.queue.extend(result for result in results if result[0] not in known)
+            self.seen.update(image.id for (_, image) in results)
+            self.has_results = True
+            self.tail_next_pos = next_pos
+
+"""In process store of the requests being selected, keyed by block_uid, so button clicks don't need to read
+or walk the result state machine in SQLite. Sessions are evicted LRU once over MAX_SESSIONS, or after TTL
+seconds idle. Status changes are written behind, coalesced by a writer thread. A miss (eg. after a restart or
+eviction) flushes any pending writes and loads the session from the database"""
+class SessionStore:
+    MAX_SESSIONS = 1000
+    TTL = 900
+    FLUSH_INTERVAL = 0.25
+
+    __sessions = OrderedDict()
+    __lock = threading.Lock()
+
+    __pending_status = {}
+    __pending_activity = {}
+    __pending_deletes = []
+    __pending_lock = threading.Lock()
+    __flush_lock = threading.Lock()
+    __wakeup = threading.Event()
+    __stopping = threading.Event()
+    __writer = None
+
+    @staticmethod
+    def enabled():
+        return SessionStore.MAX_SESSIONS > 0
+
+    @staticmethod
+    def get(block_uid: str):
+        session = SessionStore.cached(block_uid)
+        if session is not None:
+            return session
+
+        now = time.monotonic()
+        session = SessionStore.__load(block_uid)
+        with SessionStore.__lock:
+            # Another thread may have loaded it at the same time, in which case theirs is kept (unless it's expired)
+            loaded = SessionStore.__sessions.get(block_uid)
+            if loaded is not None and not SessionStore.__expired(loaded, now):
+                session = loaded
+            SessionStore.__sessions[block_uid] = session
+            session.last_used = now
+            SessionStore.__sessions.move_to_end(block_uid)
+            SessionStore.__evict(now)
+        return session
+
+    @staticmethod
+    def cached(block_uid: str):
+        # Like get, but never loads from the database (so is safe to call on the event loop), returning None instead
+        now = time.monotonic()
+        with SessionStore.__lock:
+            session = SessionStore.__sessions.get(block_uid)
+            if session is None:
+                return None
+            if SessionStore.__expired(session, now):
+                # Dropped rather than left for __evict, which only looks at the least recently used session
+                del SessionStore.__sessions[block_uid]
+                return None
+            session.last_used = now
+            SessionStore.__sessions.move_to_end(block_uid)
+            return session
+
+    @staticmethod
+    def discard(block_uid: str):
+        with SessionStore.__lock:
+            SessionStore.__sessions.pop(block_uid, None)
+
+    @staticmethod
+    def queue_status(result_id: int, status: str):
+        with SessionStore.__pending_lock:
+            SessionStore.__pending_status[result_id] = status
+        SessionStore.__written()
+
+    @staticmethod
+    def queue_activity(request_id: int):
+        # Only the latest click's time is written, however many there were since the last flush
+        with SessionStore.__pending_lock:
+            SessionStore.__pending_activity[request_id] = datetime.now().isoformat()
+        SessionStore.__written()
+
+    @staticmethod
+    def queue_delete_fetched(request_id: int):
+        with SessionStore.__pending_lock:
+            SessionStore.__pending_deletes.append(request_id)
+        SessionStore.__written()
+
+    @staticmethod
+    def start():
+        if SessionStore.__writer is not None:
+            return
+
+        SessionStore.__stopping.clear()
+        SessionStore.__writer = threading.Thread(target=SessionStore.__write_loop, name="SessionWriter", daemon=True)
+        SessionStore.__writer.start()
+        atexit.register(SessionStore.stop)
+        logging.info("Started session store for up to %s sessions", SessionStore.MAX_SESSIONS)
+
+    @staticmethod
+    def stop(timeout: float = None):
+        if SessionStore.__writer is not None:
+            SessionStore.__stopping.set()
+            SessionStore.__wakeup.set()
+            SessionStore.__writer.join(timeout)
+            SessionStore.__writer = None
+        SessionStore.flush()
+
+    @staticmethod
+    def flush():
+        # Held for the whole write, so a load after a flush sees everything queued before it
+        with SessionStore.__flush_lock:
+            with SessionStore.__pending_lock:
+                statuses = SessionStore.__pending_status
+                activity = SessionStore.__pending_activity
+                deletes = SessionStore.__pending_deletes
+                SessionStore.__pending_status = {}
+                SessionStore.__pending_activity = {}
+                SessionStore.__pending_deletes = []
+            if not statuses and not activity and not deletes:
+                return
+
+            # Status changes first, so only results that are still unused are deleted
+            with Database() as db:
+                db.executemany(Queries.SET_RESULT_STATUS,
+                               [(status, result_id) for (result_id, status) in statuses.items()])
+                db.executemany(Queries.RECORD_ACTIVITY,
+                               [(last_active, request_id) for (request_id, last_active) in activity.items()])
+                db.executemany(Queries.DELETE_UNUSED, [(request_id,) for request_id in deletes])
+            logging.debug("Flushed %s status changes, %s activity times and %s deletes", len(statuses), len(activity),
+                          len(deletes))
+
+    @staticmethod
+    def load_seen(db: Connection, request_id: int):
+        # Also used directly when sessions aren't held in memory
+        rows = db.execute(Queries.SEEN_TENOR_IDS, (request_id,)).fetchall()
+        return {row['tenor_id'] for row in rows}
+
+    @staticmethod
+    def __written():
+        # Without a writer thread (eg. scripts), writes go straight through
+        if SessionStore.__writer is None:
+            SessionStore.flush()
+        else:
+            SessionStore.__wakeup.set()
+
+    @staticmethod
+    def __write_loop():
+        while not SessionStore.__stopping.is_set():
+            SessionStore.__wakeup.wait()
+            SessionStore.__wakeup.clear()
+            # Give other clicks a moment to queue their changes, so they're written in the same transaction
+            SessionStore.__stopping.wait(SessionStore.FLUSH_INTERVAL)
+            try:
+                SessionStore.flush()
+            except Exception:
+                logging.exception("Error writing session changes to the database")
+
+    @staticmethod
+    def __evict(now: float):
+        while SessionStore.__sessions:
+            block_uid, oldest = next(iter(SessionStore.__sessions.items()))
+            if len(SessionStore.__sessions) <= SessionStore.MAX_SESSIONS and not SessionStore.__expired(oldest, now):
+                break
+            del SessionStore.__sessions[block_uid]
+
+    @staticmethod
+    def __expired(session: Session, now: float):
+        return now - session.last_used > SessionStore.TTL
+
+    @staticmethod
+    def __load(block_uid: str):
+        SessionStore.flush()
+        with Database() as db:
+            request = db.execute(Queries.FETCH_REQUEST, (block_uid,)).fetchone()
+            if request is None:
+                raise DatabaseError(f"No request stored for {block_uid}")
+
+            rows = db.execute(Queries.SESSION_RESULTS, (request['id'],)).fetchall()
+            tail = db.execute(Queries.LAST_NEXT_POSITION, (request['id'],)).fetchone()
+            seen = SessionStore.load_seen(db, request['id'])
+
+        current = []
+        queue = deque()
+        for row in rows:
+            if row['status'] == 'SELECTING':
+                # One for each image being shown
+                current.append((row['id'], Image.from_db(row)))
+            else:
+                queue.append((row['id'], Image.from_db(row)))
+
+        logging.info("Loaded session for request %s from the database (%s results queued)", block_uid, len(queue))
+        return Session(dict(request), queue, current, tail is not None, None if tail is None else tail['next_pos'],
+                       seen)
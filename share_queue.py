@@ -0,0 +1,142 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from circuitbreaker import CircuitOpenError
+from database import Database
+from queries import Queries
+from ratelimit import RateLimitedError
+
+"""Durable queue of tenor share registrations, backed by the share_registration table
+A dispatcher thread hands due rows to a bounded worker pool, retrying failures with exponential backoff until a row
+has been queued for MAX_AGE seconds. Registrations we didn't send (tenor's breaker was open, or there was no rate
+limit to spare) aren't failures, so are put back until then without counting as an attempt"""
+class ShareQueue:
+    WORKERS = 2
+    BATCH_SIZE = 20
+    MAX_AGE = 2 * 24 * 3600
+    BACKOFF_BASE = 2
+    BACKOFF_MAX = 3600
+    POLL_INTERVAL = 10
+    # Due rows are claimed by pushing their next attempt back, so other worker processes skip them meanwhile
+    CLAIM_TIMEOUT = 300
+
+    __register_fn = None
+    __executor = None
+    __dispatcher = None
+    __wakeup = threading.Event()
+    __stopping = threading.Event()
+    __in_flight = set()
+    __lock = threading.Lock()
+
+    @staticmethod
+    def enqueue(block_uid: str, tenor_id: str):
+        with Database() as db:
+            now = datetime.now().isoformat()
+            cursor = db.execute(Queries.QUEUE_SHARE, (tenor_id, now, now, block_uid))
+            if cursor.rowcount != 1:
+                logging.error("Could not queue share registration of image %s for request %s", tenor_id, block_uid)
+                return
+
+        logging.info("Queued share registration of image %s for request %s", tenor_id, block_uid)
+        ShareQueue.__wakeup.set()
+
+    @staticmethod
+    def start(register_fn):
+        # register_fn(tenor_id, search_string) should raise if tenor did not accept the registration
+        if ShareQueue.__dispatcher is not None:
+            return
+
+        ShareQueue.__register_fn = register_fn
+        ShareQueue.__stopping.clear()
+        ShareQueue.__executor = ThreadPoolExecutor(max_workers=ShareQueue.WORKERS, thread_name_prefix="ShareWorker")
+        ShareQueue.__dispatcher = threading.Thread(target=ShareQueue.__dispatch_loop, name="ShareDispatcher", daemon=True)
+        ShareQueue.__dispatcher.start()
+        logging.info("Started share registration queue with %s workers", ShareQueue.WORKERS)
+
+    @staticmethod
+    def stop(timeout: float = None):
+        if ShareQueue.__dispatcher is None:
+            return
+
+        ShareQueue.__stopping.set()
+        ShareQueue.__wakeup.set()
+        ShareQueue.__dispatcher.join(timeout)
+        ShareQueue.__executor.shutdown(wait=True)
+        ShareQueue.__dispatcher = None
+        ShareQueue.__executor = None
+
+    @staticmethod
+    def __dispatch_loop():
+        while not ShareQueue.__stopping.is_set():
+            ShareQueue.__wakeup.clear()
+            try:
+                ShareQueue.__dispatch_due()
+            except Exception:
+                logging.exception("Error dispatching share registrations")
+
+            ShareQueue.__wakeup.wait(ShareQueue.POLL_INTERVAL)
+
+    @staticmethod
+    def __dispatch_due():
+        now = datetime.now()
+        with Database() as db:
+            rows = db.execute(Queries.CLAIM_SHARES, ((now + timedelta(seconds=ShareQueue.CLAIM_TIMEOUT)).isoformat(),
+                                                     now.isoformat(), ShareQueue.BATCH_SIZE)).fetchall()
+
+        for row in rows:
+            with ShareQueue.__lock:
+                if row['id'] in ShareQueue.__in_flight:
+                    continue
+                ShareQueue.__in_flight.add(row['id'])
+            ShareQueue.__executor.submit(ShareQueue.__register, row['id'], row['tenor_id'], row['search_string'],
+                                         row['attempts'], row['queued_at'])
+
+    @staticmethod
+    def __register(row_id: int, tenor_id: str, search_string: str, attempts: int, queued_at: str):
+        try:
+            try:
+                ShareQueue.__register_fn(tenor_id, search_string)
+            except (CircuitOpenError, RateLimitedError) as e:
+                ShareQueue.__defer(row_id, tenor_id, e)
+                return
+            except Exception as e:
+                ShareQueue.__record_failure(row_id, tenor_id, attempts + 1, queued_at, e)
+                return
+
+            with Database() as db:
+                db.execute(Queries.DELETE_SHARE, (row_id,))
+            logging.info("Registered image %s as shared in tenor", tenor_id)
+        except Exception:
+            logging.exception("Error processing share registration %s", row_id)
+        finally:
+            with ShareQueue.__lock:
+                ShareQueue.__in_flight.discard(row_id)
+
+    @staticmethod
+    def __defer(row_id: int, tenor_id: str, error):
+        # Tried again once tenor can be called, at most every second
+        delay = max(1.0, error.retry_in)
+        logging.info("Not registering image %s as shared yet, retrying in %.0fs: %s", tenor_id, delay, error)
+        with Database() as db:
+            db.execute(Queries.DEFER_SHARE, ((datetime.now() + timedelta(seconds=delay)).isoformat(), row_id))
+
+    @staticmethod
+    def __record_failure(row_id: int, tenor_id: str, attempts: int, queued_at: str, error: Exception):
+        # Rows from before queued_at was recorded are given the full MAX_AGE from now
+        age = (datetime.now() - datetime.fromisoformat(queued_at)).total_seconds() if queued_at else 0
+        if age >= ShareQueue.MAX_AGE:
+            status = 'FAILED'
+            next_attempt = datetime.now()
+            logging.error("Giving up registering image %s as shared after %s attempts over %.0fs: %s",
+                          tenor_id, attempts, age, error)
+        else:
+            status = 'PENDING'
+            delay = min(ShareQueue.BACKOFF_BASE ** attempts, ShareQueue.BACKOFF_MAX)
+            next_attempt = datetime.now() + timedelta(seconds=delay)
+            logging.warning("Error registering image %s as shared (attempt %s), retrying in %ss: %s",
+                            tenor_id, attempts, delay, error)
+
+        with Database() as db:
+            db.execute(Queries.RECORD_SHARE_FAILURE, (status, attempts, next_attempt.isoformat(), row_id))
@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+
+"""Process wide LRU cache of tenor pages, keyed by (search string, locale, media filter, pos)
+Entries expire after a fixed TTL, but are kept until evicted so they can still be served stale while tenor is down
+As /random results are meant to vary, hits can be shuffled or rotated"""
+class TenorCache:
+    VARIETY_NONE = "none"
+    VARIETY_SHUFFLE = "shuffle"
+    VARIETY_ROTATE = "rotate"
+    VARIETY_MODES = (VARIETY_NONE, VARIETY_SHUFFLE, VARIETY_ROTATE)
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300, variety: str = VARIETY_SHUFFLE):
+        if variety not in TenorCache.VARIETY_MODES:
+            raise ValueError(f"Unknown cache variety mode '{variety}'")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variety = variety
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: tuple, allow_stale: bool = False):
+        if self.max_entries <= 0:
+            return None
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            stale = entry is not None and entry[0] < time.monotonic()
+            if entry is None or (stale and not allow_stale):
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            results, next_pos = entry[1], entry[2]
+
+        return self.__vary(results), next_pos
+
+    def put(self, key: tuple, results: list, next_pos):
+        if self.max_entries <= 0:
+            return
+
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, list(results), next_pos)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "evictions": self.evictions
+            }
+
+    def __vary(self, results: list):
+        results = list(results)
+        if self.variety == TenorCache.VARIETY_SHUFFLE:
+            random.shuffle(results)
+        elif self.variety == TenorCache.VARIETY_ROTATE and results:
+            offset = random.randrange(len(results))
+            results = results[offset:] + results[:offset]
+        return results
@@ -1,169 +1,671 @@
+import asyncio
+import contextvars
 import json
 import logging
 import os
-import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import Connection, DatabaseError
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from circuitbreaker import CircuitBreaker, CircuitOpenError
 from database import Database
 from image import Image
+from metrics import Counter, Histogram, Metrics
+from offload import Offload
+from page_sizer import PageSizer
+from posted_index import PostedIndex
+from queries import Queries
+from ratelimit import RateLimitedError, SingleFlight, TokenBucket
+from session_store import SessionStore
+from share_queue import ShareQueue
+from tenor_cache import TenorCache
 
+"""Results for a request, fetched from tenor (or the posted index) a page at a time and stored as they're shown
+Selecting and fetching are coroutines shared by both apps. In the async app tenor is called with HTTP_CLIENT, and
+database work goes through Offload, so neither holds a thread while waiting. Share registration runs on ShareQueue's
+own threads, so always uses the shared requests session"""
 class Tenor:
     TENOR_API_KEY = None
-    TENOR_SEARCH_URL = "https://g.tenor.com/v1/random"
-    TENOR_REGISTER_SHARE_URL = "https://g.tenor.com/v1/registershare"
+    TENOR_URL = "https://g.tenor.com/v1"
+    TENOR_SEARCH_URL = f"{TENOR_URL}/random"
+    TENOR_REGISTER_SHARE_URL = f"{TENOR_URL}/registershare"
     TENOR_LOCALE = "en_GB"
+    TENOR_MEDIA_FILTER = "default"
 
+    # Default page size, used until PageSizer has enough history
     LIMIT = 5
 
-    db = sqlite3.connect("database.db")
+    STORE_RAW_OBJECT = False
+
+    HTTP_POOL_SIZE = 10
+    HTTP_CONNECT_TIMEOUT = 3.05
+    HTTP_READ_TIMEOUT = 10
+    HTTP_RETRIES = 3
+    HTTP_RETRY_BACKOFF = 0.5
+    HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # Set by the async app (see async_app.py), otherwise searches block on the shared requests session
+    HTTP_CLIENT = None
+
+    CACHE = TenorCache()
+    LIMITER = TokenBucket(rate=5, burst=10, max_wait=2)
+    # Fraction of LIMITER's burst that prefetches and share registrations leave for clicks
+    BACKGROUND_HEADROOM = 0.5
+    RATE_LIMITED_PAUSE = 5
+    BREAKER = CircuitBreaker("tenor", failure_threshold=5, reset_timeout=30, half_open_calls=1)
+
+    __page_requests = SingleFlight()
+
+    QUERY_TIMER = Histogram("tenor_query_seconds", "Time taken to fetch and store the next page of results for a request")
+    HTTP_TIMER = Histogram("tenor_http_seconds", "Time taken by requests to tenor, including retries", ("endpoint",))
+    SHARE_TIMER = Histogram("register_share_seconds", "Time taken to queue a posted gif for share registration")
+    PAGES = Counter("tenor_pages_total", "Pages of results fetched for requests, by where they came from", ("source",))
+    RESULTS = Counter("tenor_results_total", "Results fetched for requests, by whether they were new or a repeat " +
+                      "of one the request already had (and so dropped)", ("outcome",))
+
+    PREFETCH_LOW_WATER = 2
+    PREFETCH_WORKERS = 4
+
+    # Extra pages fetched when repeats leave less than a page's worth of new results (0 to only fetch the one)
+    OVERFETCH_PAGES = 2
+
+    __page_fetches = SingleFlight()
+    __prefetch_executor = None
+    __prefetch_in_flight = set()
+    __prefetch_tasks = set()
+    __prefetch_lock = threading.Lock()
+    # Set while a prefetch is fetching, as it takes its token before starting (see __prefetch)
+    __prefetching = contextvars.ContextVar("prefetching", default=False)
+
+    __session = None
+    __session_lock = threading.Lock()
+
+    @staticmethod
+    def set_url(url: str):
+        # Eg. to point at the stub server in benchmark/
+        Tenor.TENOR_URL = url.rstrip("/")
+        Tenor.TENOR_SEARCH_URL = f"{Tenor.TENOR_URL}/random"
+        Tenor.TENOR_REGISTER_SHARE_URL = f"{Tenor.TENOR_URL}/registershare"
 
     def __init__(self, block_uid):
         if Tenor.TENOR_API_KEY is None:
             raise RuntimeError("Tenor API Key not set")
 
         self.block_uid = block_uid
+        self.__request = None
 
-    def next_image(self):
-        with Database() as db:
-            previous_image = self.__set_image_as_used_and_get(db)
-            next_image = self.__next_image_from_db(db)
-            if next_image is None:
-                logging.info(f"No more images stored for request {self.block_uid}")
-
-                pos = None
-                if previous_image is not None:
-                    pos = previous_image['next_pos']
-                    if pos is None:
-                        raise DatabaseError(f"Had a previous gif without next position for request {self.block_uid}. " +
-                                            f"Previous image id: {previous_image['id']}")
-                self.__query_tenor(db, pos)
-                next_image = self.__next_image_from_db(db)
-                if next_image is None:
-                    raise DatabaseError(f"Tried fetching more images, but could not fetch more from the DB")
-
-            return Tenor.__unpack_gif_object_from_db(next_image)
-
-    def get_send_image_and_delete_others(self):
+    async def next_image(self):
+        return (await self.next_images(1))[0][1]
+
+    async def next_images(self, count: int):
+        # Retires the results being shown, and selects up to count more as (tenor_result id, Image) pairs
+        if SessionStore.enabled():
+            return await self.__next_images_from_session(count)
+
+        request_id, selected, remaining = await Offload.call(self.__start_selection, count)
+
+        while len(selected) < count:
+            # Outside the transaction above, so we aren't holding a connection or the write lock while waiting on tenor
+            logging.info("No more images stored for request %s", self.block_uid)
+            fetched = await self.__fetch_more()
+
+            # Another click for this request may have been served in the meantime, so retire whatever it selected
+            more, remaining = await Offload.call(Tenor.__continue_selection, request_id, count - len(selected),
+                                                 not selected)
+            selected += more
+            if not more and fetched == 0:
+                break
+
+        if not selected:
+            raise DatabaseError(f"Tried fetching more images, but could not fetch more from the DB")
+
+        # Scheduled once the transactions above have committed, so the prefetch isn't waiting on our write lock
+        if remaining < Tenor.PREFETCH_LOW_WATER:
+            self.__schedule_prefetch()
+
+        return [(row['id'], Image.from_db(row)) for row in selected]
+
+    async def get_send_image_and_delete_others(self, result_id: int = None):
+        # Sends the chosen result (eg. from a grid), or the one being shown if there's no choice
+        if SessionStore.enabled():
+            send_image = (await self.__search_session()).take_current(result_id)
+            if send_image is None:
+                raise DatabaseError(f"Could not get image to send for request {self.block_uid}")
+            SessionStore.discard(self.block_uid)
+            return send_image
+
+        return await Offload.call(self.__take_send_image, result_id)
+
+    def __take_send_image(self, result_id: int):
         with Database() as db:
-            send_image = self.__set_image_as_used_and_get(db)
+            request_id = self.__get_request_id(db)
+            shown = self.__retire_selected_images(db, request_id)
+            send_image = next((row for row in shown if result_id is None or row['id'] == result_id), None)
             if send_image is None:
+                # Rolled back on the way out, so the results being shown stay selected
                 raise DatabaseError(f"Could not get image to send for request {self.block_uid}")
 
-            # language=SQL
-            deleted_rows = db.execute("""
-                DELETE FROM tenor_result
-                WHERE id IN (
-                    SELECT tr.id FROM tenor_result tr
-                    INNER JOIN slack_request sr ON (sr.id = tr.slack_request_id)
-                    WHERE block_uid = ?
-                    AND tr.status = 'FETCHED'
-                )
-                """, (self.block_uid,)).rowcount
-            logging.info(f"Deleted {deleted_rows} unused requests for request {self.block_uid}")
-            return Tenor.__unpack_gif_object_from_db(send_image)
+            deleted_rows = db.execute(Queries.DELETE_UNUSED, (request_id,)).rowcount
+            logging.info("Deleted %s unused requests for request %s", deleted_rows, self.block_uid)
+            return Image.from_db(send_image)
+
+    @Metrics.timed(SHARE_TIMER)
+    async def register_image_as_shared(self, image: Image):
+        # Registration happens in the background, so the send handler doesn't wait on tenor
+        await Offload.call(ShareQueue.enqueue, self.block_uid, image.id)
+
+    @staticmethod
+    def register_share(tenor_id: str, search_string: str):
+        Tenor.__allow_request()
+        Tenor.__acquire_background_quota()
+        with Tenor.__recording_failures():
+            resp = Tenor.__http_get(Tenor.TENOR_REGISTER_SHARE_URL, params={
+                "id": tenor_id,
+                "key": Tenor.TENOR_API_KEY,
+                "q": search_string,
+                "locale": Tenor.TENOR_LOCALE,
+            })
+            Tenor.__check_rate_limited(resp)
+            if not resp.ok:
+                raise RuntimeError(f"Got status code {resp.status_code} for tenor share registration")
+
+    @staticmethod
+    def collect_metrics():
+        stats = Tenor.CACHE.stats()
+        return [
+            ("tenor_cache_entries", "gauge", "Pages currently held in the tenor cache", stats["entries"]),
+            ("tenor_cache_hits_total", "counter", "Tenor cache lookups served from the cache", stats["hits"]),
+            ("tenor_cache_misses_total", "counter", "Tenor cache lookups not in the cache", stats["misses"]),
+            ("tenor_cache_stale_hits_total", "counter", "Expired cache entries served while tenor was unavailable",
+             stats["stale_hits"]),
+            ("tenor_cache_evictions_total", "counter", "Pages evicted from the tenor cache", stats["evictions"]),
+            ("tenor_coalesced_total", "counter", "Tenor requests that waited on an identical request instead",
+             Tenor.__page_requests.coalesced),
+            ("tenor_rate_limit_granted_total", "counter", "Tenor requests allowed by the rate limit",
+             Tenor.LIMITER.granted),
+            ("tenor_rate_limit_rejected_total", "counter", "Tenor requests rejected by the rate limit",
+             Tenor.LIMITER.rejected),
+            ("tenor_breaker_state", "gauge", "Tenor circuit breaker state (0 closed, 1 probing, 2 open)",
+             [CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN].index(Tenor.BREAKER.state))
+        ]
+
+    async def fetch_request(self):
+        if SessionStore.enabled():
+            return (await self.__search_session()).request
+
+        if self.__request is None:
+            await Offload.call(self.__load_request_once)
+        return self.__request
+
+    async def __search_session(self):
+        # Held in memory for most clicks, so only a load from the database is offloaded
+        session = SessionStore.cached(self.block_uid)
+        if session is None:
+            session = await Offload.call(SessionStore.get, self.block_uid)
+        return session
+
+    def __load_request_once(self):
+        with Database() as db:
+            self.__load_request(db)
+
+    def __load_request(self, db: Connection):
+        self.__request = db.execute(Queries.FETCH_REQUEST, (self.block_uid,)).fetchone()
+        if self.__request is None:
+            raise DatabaseError(f"No request stored for {self.block_uid}")
+
+    async def __next_images_from_session(self, count: int):
+        # Same flow as next_images, but against the in memory session rather than the database
+        session = await self.__search_session()
+        selected, remaining = session.advance(count)
+        SessionStore.queue_activity(session.request['id'])
+        while len(selected) < count:
+            logging.info("No more images stored for request %s", self.block_uid)
+            fetched = await self.__fetch_more()
+
+            more, remaining = session.advance(count - len(selected), retire=not selected)
+            selected += more
+            if not more and fetched == 0:
+                break
+
+        if not selected:
+            raise DatabaseError(f"Tried fetching more images, but could not fetch more from the DB")
+
+        if remaining < Tenor.PREFETCH_LOW_WATER:
+            self.__schedule_prefetch()
+
+        return selected
+
+    def __start_selection(self, count: int):
+        with Database() as db:
+            request_id = self.__get_request_id(db)
+            self.__retire_selected_images(db, request_id)
+            selected, remaining = self.__select_next_images(db, request_id, count)
+            Tenor.__record_activity(db, request_id)
+        return request_id, selected, remaining
+
+    @staticmethod
+    def __continue_selection(request_id: int, count: int, retire: bool):
+        with Database() as db:
+            if retire:
+                Tenor.__retire_selected_images(db, request_id)
+            return Tenor.__select_next_images(db, request_id, count)
+
+    def __get_request_id(self, db: Connection):
+        # Resolved once per handler, rather than joining on block_uid in every statement
+        if self.__request is None:
+            self.__load_request(db)
+        return self.__request['id']
+
+    @staticmethod
+    def __select_next_images(db: Connection, request_id: int, count: int):
+        selected = Tenor.__record_state_transition(db, request_id, 'FETCHED', 'SELECTING', count)
+        if not selected:
+            return [], 0
+        return selected, Tenor.__count_fetched_images(db, request_id)
+
+    @staticmethod
+    def __record_activity(db: Connection, request_id: int):
+        # Read by the janitor, which expires requests that haven't been clicked for a while
+        db.execute(Queries.RECORD_ACTIVITY, (datetime.now().isoformat(), request_id))
+
+    @staticmethod
+    def __count_fetched_images(db: Connection, request_id: int):
+        return db.execute(Queries.COUNT_FETCHED, (request_id,)).fetchone()[0]
+
+    @staticmethod
+    def __stored_tail(db: Connection, request_id: int):
+        # Whether any results are stored for the request, and the position of the page after the last one
+        last_image = db.execute(Queries.LAST_NEXT_POSITION, (request_id,)).fetchone()
+        return last_image is not None, None if last_image is None else last_image['next_pos']
+
+    def __schedule_prefetch(self):
+        with Tenor.__prefetch_lock:
+            if self.block_uid in Tenor.__prefetch_in_flight:
+                return
+            Tenor.__prefetch_in_flight.add(self.block_uid)
+
+        if Offload.enabled():
+            # A task on the event loop, so waiting on tenor doesn't hold a thread. A reference is kept until it's done
+            task = asyncio.get_running_loop().create_task(self.__prefetch())
+            Tenor.__prefetch_tasks.add(task)
+            task.add_done_callback(Tenor.__prefetch_tasks.discard)
+            return
+
+        with Tenor.__prefetch_lock:
+            if Tenor.__prefetch_executor is None:
+                Tenor.__prefetch_executor = ThreadPoolExecutor(max_workers=Tenor.PREFETCH_WORKERS,
+                                                               thread_name_prefix="TenorPrefetch")
+        Tenor.__prefetch_executor.submit(Offload.run, self.__prefetch())
+
+    async def __fetch_more(self):
+        # Fetched by the click itself, so clicks never queue behind background prefetches. Concurrent clicks for
+        # a request (or a prefetch already running) share one fetch rather than storing the page twice
+        return await Tenor.__page_fetches.do(self.block_uid, self.__fetch_next_page)
+
+    async def __prefetch(self):
+        try:
+            # A click may have fetched a page while this was queued
+            if await self.__count_unseen() >= Tenor.PREFETCH_LOW_WATER:
+                return 0
+            try:
+                Tenor.__acquire_background_quota()
+            except RateLimitedError:
+                # The click that runs out of results fetches the page itself
+                logging.info("Skipping prefetch for request %s to leave tenor requests for clicks", self.block_uid)
+                return 0
+            Tenor.__prefetching.set(True)
+            return await Tenor.__page_fetches.do(self.block_uid, self.__fetch_next_page)
+        except Exception:
+            logging.exception("Error prefetching images for request %s", self.block_uid)
+        finally:
+            with Tenor.__prefetch_lock:
+                Tenor.__prefetch_in_flight.discard(self.block_uid)
+
+    async def __count_unseen(self):
+        if SessionStore.enabled():
+            session = await self.__search_session()
+            with session.lock:
+                return len(session.queue)
+        return await Offload.call(self.__count_unseen_stored)
+
+    def __count_unseen_stored(self):
+        with Database() as db:
+            return Tenor.__count_fetched_images(db, self.__get_request_id(db))
 
-    def register_image_as_shared(self, image: Image):
-        # Try to register share on tenor
-        request = self.fetch_request()
+    async def __fetch_next_page(self):
+        if SessionStore.enabled():
+            session = await self.__search_session()
+            request_id = session.request['id']
+            has_results, next_pos = session.has_results, session.tail_next_pos
+        else:
+            request_id, (has_results, next_pos) = await Offload.call(self.__stored_tail_of_request)
+
+        if has_results and next_pos is None:
+            logging.warning("Last stored image for request %s has no next position", self.block_uid)
+            return 0
+
+        logging.info("Fetching next page for request %s", self.block_uid)
+        return await self.__query_tenor(request_id, next_pos, first_page=not has_results)
+
+    def __stored_tail_of_request(self):
+        with Database() as db:
+            request_id = self.__get_request_id(db)
+            return request_id, Tenor.__stored_tail(db, request_id)
+
+    @staticmethod
+    def __allow_request():
+        if not Tenor.BREAKER.allow():
+            retry_in = Tenor.BREAKER.retry_in()
+            raise CircuitOpenError(f"Not calling tenor, as it has been failing (retrying in {retry_in:.0f}s)", retry_in)
+
+    @staticmethod
+    @contextmanager
+    def __recording_failures():
+        # Errors and timeouts from tenor count towards opening the breaker, but our own rate limit doesn't
         try:
-            requests.get(Tenor.TENOR_REGISTER_SHARE_URL, params={
-                "id": image.get_id(),
+            yield
+        except Exception:
+            Tenor.BREAKER.record_failure()
+            raise
+        Tenor.BREAKER.record_success()
+
+    @staticmethod
+    def __acquire_background_quota():
+        # Never queues, and leaves some of the burst, so clicks don't wait behind prefetches and share registrations
+        keep = min(Tenor.LIMITER.burst - 1, int(Tenor.LIMITER.burst * Tenor.BACKGROUND_HEADROOM))
+        if not Tenor.LIMITER.try_acquire(keep):
+            raise RateLimitedError("Leaving the tenor rate limit for searches", Tenor.LIMITER.retry_in(keep))
+
+    @staticmethod
+    async def __acquire_quota_async():
+        if not await Tenor.LIMITER.acquire_async():
+            raise RateLimitedError(f"Tenor request rate limit reached, waited up to {Tenor.LIMITER.max_wait}s",
+                                   Tenor.LIMITER.retry_in())
+
+    @staticmethod
+    def __check_rate_limited(resp):
+        # Still 429 after retrying, so stop everyone else spending quota for a while
+        if resp.status_code == 429:
+            try:
+                pause = float(resp.headers.get("Retry-After", Tenor.RATE_LIMITED_PAUSE))
+            except ValueError:
+                pause = Tenor.RATE_LIMITED_PAUSE
+            logging.warning("Tenor rate limited us, pausing requests for %ss", pause)
+            Tenor.LIMITER.pause(pause)
+
+    @staticmethod
+    def __http_get(url, params):
+        with Tenor.HTTP_TIMER.time(url.rsplit("/", 1)[-1]):
+            return Tenor.__get_session().get(url, params=params,
+                                             timeout=(Tenor.HTTP_CONNECT_TIMEOUT, Tenor.HTTP_READ_TIMEOUT))
+
+    @staticmethod
+    async def __http_get_async(url, params):
+        # Blocks the calling thread (and its event loop) on the requests session, unless the async app set a client
+        if Tenor.HTTP_CLIENT is None:
+            return Tenor.__http_get(url, params)
+        with Tenor.HTTP_TIMER.time(url.rsplit("/", 1)[-1]):
+            return await Tenor.HTTP_CLIENT.get(url, params)
+
+    @staticmethod
+    def __get_session():
+        # Shared between all worker threads so connections to tenor are kept alive and reused
+        with Tenor.__session_lock:
+            if Tenor.__session is None:
+                retry = CappedRetry(
+                    total=Tenor.HTTP_RETRIES,
+                    backoff_factor=Tenor.HTTP_RETRY_BACKOFF,
+                    status_forcelist=Tenor.HTTP_RETRY_STATUSES,
+                    allowed_methods=["GET"],
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=Tenor.HTTP_POOL_SIZE, max_retries=retry)
+
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                Tenor.__session = session
+            return Tenor.__session
+
+    @staticmethod
+    def __retire_selected_images(db: Connection, request_id: int):
+        # Normally just the one being shown, or a grid's worth. Returned so a send can pick from them
+        return Tenor.__record_state_transition(db, request_id, 'SELECTING', 'USED', -1)
+
+    @staticmethod
+    def __record_state_transition(db: Connection, request_id: int, old_status: str, new_status: str, limit: int):
+        # Connections begin IMMEDIATE transactions, so rows are picked and moved under the write lock
+        rows = db.execute(Queries.STATE_TRANSITION, (new_status, request_id, old_status, limit)).fetchall()
+        return sorted(rows, key=lambda row: row['position'])
+
+    @staticmethod
+    def __cache_key(search_string: str, pos, limit: int):
+        return search_string, Tenor.TENOR_LOCALE, Tenor.TENOR_MEDIA_FILTER, pos or None, limit
+
+    async def __fetch_page(self, search_string: str, pos, limit: int):
+        cache_key = Tenor.__cache_key(search_string, pos, limit)
+        cached = Tenor.CACHE.get(cache_key)
+        if cached is not None:
+            logging.info("Using cached tenor results for request %s with query string: %s",
+                         self.block_uid, search_string)
+            Tenor.PAGES.inc("cache")
+            return cached
+
+        # Concurrent identical searches (eg. several people in a channel) share one upstream request
+        return await Tenor.__page_requests.do(cache_key,
+                                              lambda: self.__request_page(search_string, pos, limit, cache_key))
+
+    async def __request_page(self, search_string: str, pos, limit: int, cache_key: tuple):
+        Tenor.__allow_request()
+        if not Tenor.__prefetching.get():
+            await Tenor.__acquire_quota_async()
+
+        logging.info("Fetching results from tenor for request %s with query string: %s", self.block_uid, search_string)
+        with Tenor.__recording_failures():
+            resp = await Tenor.__http_get_async(Tenor.TENOR_SEARCH_URL, params={
                 "key": Tenor.TENOR_API_KEY,
-                "q": request['search_string'],
+                "q": search_string,
                 "locale": Tenor.TENOR_LOCALE,
+                "limit": limit,
+                "media_filter": Tenor.TENOR_MEDIA_FILTER,
+                "ar_range": "all",
+                "pos": pos or None
             })
+            Tenor.__check_rate_limited(resp)
+            if not resp.ok:
+                raise RuntimeError(f"Got status code {resp.status_code} for tenor request")
+
+            content = json.loads(resp.content)
+        Tenor.PAGES.inc("tenor")
+        Tenor.CACHE.put(cache_key, content['results'], content['next'])
+        return content['results'], content['next']
+
+    @Metrics.timed(QUERY_TIMER)
+    async def __query_tenor(self, request_id: int, next_pos, first_page: bool):
+        request = await self.fetch_request()
+        search_string = request['search_string']
+        first_limit, follow_up_limit = await Offload.call(PageSizer.page_sizes, search_string, request['user_id'],
+                                                          Tenor.LIMIT)
+        limit = first_limit if first_page else follow_up_limit
+
+        modifier = PostedIndex.parse(search_string)
+        if modifier is not None:
+            images, new_pos = await Offload.call(Tenor.__posted_page, request, modifier, next_pos, limit)
+            logging.info("Found %s posted gifs for request %s", len(images), self.block_uid)
+        else:
+            images, new_pos = await self.__fetch_unseen(request_id, search_string, next_pos, limit)
+        fetched_from, next_pos = next_pos, new_pos
+
+        stored = await Offload.call(self.__store_page_once, request_id, images, first_page, fetched_from, next_pos)
+        if stored is None:
+            return 0
+        if stored and SessionStore.enabled():
+            (await self.__search_session()).extend(stored, next_pos)
+
+        logging.info("Inserted %s rows for request %s (page size %s)", len(stored), self.block_uid, limit)
+        return len(stored)
+
+    def __store_page_once(self, request_id: int, images: list, first_page: bool, fetched_from, next_pos):
+        with Database() as db:
+            # Prefetches are only de-duplicated within a process, so another worker may have stored this page already
+            db.execute("BEGIN IMMEDIATE")
+            if Tenor.__stored_tail(db, request_id) != (not first_page, fetched_from):
+                logging.info("Page for request %s was stored by another worker, discarding it", self.block_uid)
+                return None
+            return Tenor.store_images(db, request_id, images, next_pos)
+
+    async def __fetch_unseen(self, request_id: int, search_string: str, pos, limit: int):
+        # tenor's random results repeat across pages, so ones the request already has are dropped, and more pages
+        # fetched until there's a page's worth of new results (the posted index has no repeats, so skips this)
+        seen = await self.__seen_ids(request_id)
+        unseen = []
+        # A prefetch only has the one token it took up front
+        pages = 1 if Tenor.__prefetching.get() else 1 + max(0, Tenor.OVERFETCH_PAGES)
+        for page in range(pages):
+            try:
+                images, new_pos = await self.__fetch_page_or_fallback(request_id, search_string, pos, limit)
+            except Exception:
+                if page == 0:
+                    raise
+                # Whatever new results we already have are still worth storing
+                logging.warning("Could not fetch extra page for request %s", self.block_uid, exc_info=True)
+                break
+            new = []
+            for image, obj in images:
+                if image.id not in seen:
+                    seen.add(image.id)
+                    new.append((image, obj))
+            Tenor.RESULTS.inc("new", amount=len(new))
+            Tenor.RESULTS.inc("duplicate", amount=len(images) - len(new))
+            if len(new) < len(images):
+                logging.info("Dropped %s repeated results for request %s", len(images) - len(new), self.block_uid)
+
+            unseen += new
+            # A fallback page keeps our position, so fetching again would only give the same results
+            advanced = new_pos != pos
+            pos = new_pos
+            if len(unseen) >= limit or not images or not advanced:
+                break
+
+        if not unseen and images:
+            # Better to show repeats than to have Next fail once tenor has nothing new for the query
+            logging.info("Only repeated results left for request %s, storing them anyway", self.block_uid)
+            return images, pos
+        return unseen, pos
+
+    async def __seen_ids(self, request_id: int):
+        if SessionStore.enabled():
+            session = await self.__search_session()
+            with session.lock:
+                return set(session.seen)
+        return await Offload.call(Tenor.__load_seen, request_id)
+
+    @staticmethod
+    def __load_seen(request_id: int):
+        with Database() as db:
+            return SessionStore.load_seen(db, request_id)
+
+    async def __fetch_page_or_fallback(self, request_id: int, search_string: str, pos, limit: int):
+        try:
+            results, new_pos = await self.__fetch_page(search_string, pos, limit)
+            logging.info("Fetched %s from tenor for request %s", len(results), self.block_uid)
+            return Tenor.__project(results), new_pos
         except Exception as e:
-            logging.error(f"Error registering image {image.get_id()} as shared in tenor for request {self.block_uid}", e)
+            images, new_pos = await Offload.call(Tenor.__fallback_page, request_id, search_string, pos, limit)
+            if not images:
+                raise
+            logging.warning("Could not fetch from tenor for request %s (%s), using %s previously fetched results",
+                            self.block_uid, e, len(images))
+            return images, new_pos
 
-        logging.info(f"Registered image {image.get_id()} as shared in tenor for request {self.block_uid}")
+    @staticmethod
+    def __posted_page(request, modifier: tuple, pos, limit: int):
+        # Paged by offset through the local index, rather than tenor. Starts again at the end, so Next keeps working
+        offset = int(pos or 0)
+        with Database() as db:
+            rows = PostedIndex.lookup(db, request, *modifier, offset, limit)
+            if not rows and offset > 0:
+                offset, rows = 0, PostedIndex.lookup(db, request, *modifier, 0, limit)
+        Tenor.PAGES.inc("posted_index")
+
+        next_offset = offset + len(rows) if len(rows) == limit else 0
+        return [(Image.from_db(row), None) for row in rows], str(next_offset)
+
+    @staticmethod
+    def __fallback_page(request_id: int, search_string: str, pos, limit: int):
+        # A page cached earlier is the closest to what tenor would have returned, even if it's past its TTL
+        stale = Tenor.CACHE.get(Tenor.__cache_key(search_string, pos, limit), allow_stale=True)
+        if stale is not None:
+            Tenor.PAGES.inc("stale_cache")
+            return Tenor.__project(stale[0]), stale[1]
 
-    def fetch_request(self):
         with Database() as db:
-            return db.execute("""
-                SELECT * FROM slack_request
-                WHERE block_uid = ?""",
-                              (self.block_uid,)
-                              ).fetchone()
-
-    @staticmethod
-    def __unpack_gif_object_from_db(db_result):
-        return Image(json.loads(db_result['gif_object']))
-
-    def __set_image_as_used_and_get(self, db: Connection):
-        return self.__record_state_transition(db, 'SELECTING', 'USED')
-
-    def __next_image_from_db(self, db: Connection):
-        return self.__record_state_transition(db, 'FETCHED', 'SELECTING')
-
-    def __record_state_transition(self, db: Connection, old_status: str, new_status: str):
-        # language=SQL
-        row = db.execute("""
-            SELECT tr.id FROM tenor_result tr
-            INNER JOIN slack_request sr ON (tr.slack_request_id = sr.id)
-            WHERE sr.block_uid = ?
-            AND tr.status = ?
-            ORDER BY position ASC
-            LIMIT 1
-            """, (self.block_uid, old_status)).fetchone()
-        if row is None:
-            return None
-        row_id = row['id']
-
-        # language=SQL
-        db.execute("""
-            UPDATE tenor_result
-            SET status = ?
-            WHERE id = ?
-            """, (new_status, row_id))
-        # language=SQL
-        return db.execute("SELECT * FROM tenor_result WHERE id = ?", (row_id,)).fetchone()
-
-    def __query_tenor(self, db: Connection, next_pos):
-        search_string = db.execute("SELECT search_string FROM slack_request WHERE block_uid = ?", (self.block_uid,)) \
-            .fetchone()['search_string']
-
-        logging.info(f"Fetching results from tenor for request {self.block_uid} with query string: {search_string}")
-        resp = requests.get(Tenor.TENOR_SEARCH_URL, params={
-            "key": Tenor.TENOR_API_KEY,
-            "q": search_string,
-            "locale": Tenor.TENOR_LOCALE,
-            "limit": 5,
-            "media_filter": "default",
-            "ar_range": "all",
-            "pos": next_pos
-        })
-        if not resp.ok:
-            raise RuntimeError(f"Got status code {resp.status_code} for tenor request")
-
-        content = json.loads(resp.content)
-        next_pos = content['next']
-        results = content['results']
-
-        logging.info(f"Fetched {len(results)} from tenor for request {self.block_uid}")
-
-        for i, obj in enumerate(results, start=0):
-            if i + 1 == len(results):
-                pos = next_pos
-            else:
-                pos = None
-
-            # language=SQL
-            cursor = db.execute("""
-                INSERT INTO tenor_result (slack_request_id, position, gif_object, status, next_pos)
-                SELECT
-                    sr.id,
-                    COALESCE(MAX(position), 0) + 1,
-                    ?,
-                    'FETCHED',
-                    ?
-                FROM slack_request sr
-                LEFT JOIN tenor_result tr ON (sr.id = tr.slack_request_id)
-                WHERE sr.block_uid = ?
-                GROUP BY sr.id
-                """, (json.dumps(results[i]), pos, self.block_uid))
-            if cursor.rowcount != 1:
-                raise DatabaseError(f"Error inserting row for request {self.block_uid}")
-
-        logging.info(f"Inserted rows for request {self.block_uid}")
+            rows = Tenor.__previous_results(db, request_id, search_string, limit)
+        if rows:
+            Tenor.PAGES.inc("previous_results")
+        # Our position is kept (an empty one for the first page), so we carry on from here once tenor is back
+        return [(Image.from_db(row), None) for row in rows], pos or ""
+
+    @staticmethod
+    def __previous_results(db: Connection, request_id: int, search_string: str, limit: int):
+        # Results already shown for this query in other requests, then for queries containing it or its longest word
+        escaped = search_string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        patterns = [escaped, f"%{escaped}%"]
+        words = escaped.split()
+        if len(words) > 1:
+            patterns.append(f"%{max(words, key=len)}%")
+
+        for pattern in patterns:
+            rows = db.execute(Queries.PREVIOUS_RESULTS, (pattern, request_id, request_id, limit)).fetchall()
+            if rows:
+                return rows
+        return []
+
+    @staticmethod
+    def __project(results: list):
+        images = []
+        for obj in results:
+            try:
+                images.append((Image.from_tenor(obj), obj))
+            except (KeyError, ValueError):
+                logging.warning("Skipping tenor result %s that can't be displayed", obj.get('id'))
+        return images
+
+    @staticmethod
+    def store_page(db: Connection, request_id: int, results: list, next_pos):
+        return Tenor.store_images(db, request_id, Tenor.__project(results), next_pos)
+
+    @staticmethod
+    def store_images(db: Connection, request_id: int, images: list, next_pos):
+        # Images are (Image, tenor object) pairs, where the object is None for results that didn't come from tenor
+        if not images:
+            return []
+
+        # Starting position is read once under the write lock, then the whole page is written in one go
+        if not db.in_transaction:
+            db.execute("BEGIN IMMEDIATE")
+        start = db.execute(Queries.MAX_POSITION, (request_id,)).fetchone()[0]
+
+        last = len(images) - 1
+        rows = []
+        for i, (image, obj) in enumerate(images):
+            raw_object = zlib.compress(json.dumps(obj).encode()) if Tenor.STORE_RAW_OBJECT and obj is not None else None
+            rows.append((request_id, start + i + 1, image.id, image.description, image.url, image.size,
+                         image.small_url, image.small_size, raw_object, next_pos if i == last else None))
+
+        db.executemany(Queries.STORE_RESULT, rows)
+        ids = db.execute(Queries.STORED_RESULT_IDS, (request_id, start)).fetchall()
+        return [(row['id'], image) for (row, (image, _)) in zip(ids, images)]
+
+"""Waits at most HTTP_READ_TIMEOUT for a Retry-After before retrying, so a 429 can't stall a click for minutes
+A longer pause asked for by tenor is still applied to everyone through Tenor.LIMITER (see __check_rate_limited)"""
+class CappedRetry(Retry):
+    def parse_retry_after(self, retry_after: str):
+        return min(super().parse_retry_after(retry_after), Tenor.HTTP_READ_TIMEOUT)
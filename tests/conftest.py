@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.stubs import StubTenor
+from database import Database, SqliteBackend
+from migrations import Migrations
+from ratelimit import TokenBucket
+from tenor_cache import TenorCache
+from tenor_search import Tenor
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # A fresh, fully migrated SQLite file per test
+    Database.close_all()
+    monkeypatch.setattr(Database, "BACKEND", SqliteBackend(str(tmp_path / "database.db")))
+    Migrations.migrate()
+    yield Database
+    Database.close_all()
+
+
+@pytest.fixture
+def stub_tenor(monkeypatch):
+    # Uncached and unlimited, so every page really is fetched from the stub
+    stub = StubTenor(latency=0.01).start()
+    monkeypatch.setattr(Tenor, "TENOR_API_KEY", "test")
+    monkeypatch.setattr(Tenor, "TENOR_URL", stub.url)
+    monkeypatch.setattr(Tenor, "TENOR_SEARCH_URL", f"{stub.url}/random")
+    monkeypatch.setattr(Tenor, "TENOR_REGISTER_SHARE_URL", f"{stub.url}/registershare")
+    monkeypatch.setattr(Tenor, "CACHE", TenorCache(max_entries=0))
+    monkeypatch.setattr(Tenor, "LIMITER", TokenBucket(rate=0, burst=0, max_wait=0))
+    yield stub
+    stub.stop()
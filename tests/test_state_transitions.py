@@ -0,0 +1,58 @@
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import pytest
+
+from offload import Offload
+from session_store import SessionStore
+from tenor_search import Tenor
+
+THREADS = 16
+CLICKS = 20
+
+
+def create_request(db_class):
+    block_uid = str(uuid.uuid4())
+    with db_class() as db:
+        db.execute("""
+            INSERT INTO slack_request (timestamp, user_id, conversation_id, block_uid, search_string, status,
+                                       last_active)
+            VALUES (?, 'user', 'conversation', ?, 'party', 'SELECTING', ?)
+            """, (datetime.now().isoformat(), block_uid, datetime.now().isoformat()))
+    return block_uid
+
+
+@pytest.mark.parametrize("max_sessions", [0, 1000], ids=["database", "session_store"])
+def test_concurrent_next_clicks(database, stub_tenor, monkeypatch, max_sessions):
+    # Many Next clicks for one search at once, each of which has to fetch pages from tenor as it goes
+    monkeypatch.setattr(SessionStore, "MAX_SESSIONS", max_sessions)
+    monkeypatch.setattr(Tenor, "PREFETCH_LOW_WATER", 0)
+    block_uid = create_request(database)
+
+    served, errors = [], []
+
+    def click():
+        for _ in range(CLICKS):
+            try:
+                served.append(Offload.run(Tenor(block_uid).next_image()).id)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=click) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    SessionStore.flush()
+
+    assert errors == []
+    assert len(served) == THREADS * CLICKS
+    assert [tenor_id for tenor_id, count in Counter(served).items() if count > 1] == []
+
+    with database() as db:
+        statuses = dict(db.execute("SELECT status, COUNT(*) FROM tenor_result GROUP BY status").fetchall())
+    # Every click retires the image before it, leaving only the last one served being shown
+    assert statuses.get('SELECTING') == 1
+    assert statuses.get('USED') == THREADS * CLICKS - 1
@@ -0,0 +1,38 @@
+import logging
+import os
+import shlex
+
+from main import configure, parser, start_background_jobs
+from metrics import Metrics
+from session_store import SessionStore
+
+"""WSGI/ASGI entry point, for serving with several worker processes rather than main.py's single one, eg.
+    SLACK_TENOR_ARGS="<bot token> <signing secret> <tenor key> --database http://db:8080" gunicorn -w 4 wsgi:application
+    SLACK_TENOR_ARGS="<...> --async" uvicorn --workers 4 wsgi:application
+main.py's arguments are read from SLACK_TENOR_ARGS, and with --async the app is served over ASGI rather than WSGI
+Each worker sets itself up when it imports this module, so don't preload the app (neither the connection pool nor
+the background threads survive forking). A SQLite --database can only be shared by workers on the same node
+
+Any worker may receive a search's button clicks, so each click reads the search's state from the database
+The in memory session store is turned off, as it would only know about the clicks its own worker handled"""
+
+args = parser.parse_args(shlex.split(os.environ.get("SLACK_TENOR_ARGS", "")))
+app = configure(args)
+
+if SessionStore.enabled():
+    logging.info("Not holding searches in memory, as clicks may be handled by any worker")
+    SessionStore.MAX_SESSIONS = 0
+if Metrics.ENABLED:
+    # Each worker would only count its own requests, and they can't all listen on one port
+    logging.warning("Metrics aren't served when running with multiple workers, ignoring --metrics-port")
+    Metrics.ENABLED = False
+
+start_background_jobs(args)
+
+if args.use_async:
+    # Imported here, so only the adapter for the mode in use is loaded
+    from slack_bolt.adapter.asgi.async_handler import AsyncSlackRequestHandler
+    application = AsyncSlackRequestHandler(app, path="/tenor")
+else:
+    from slack_bolt.adapter.wsgi import SlackRequestHandler
+    application = SlackRequestHandler(app, path="/tenor")